@@ -5,131 +5,157 @@ import datareader as dr
 import preprocessing
 import analysis as anal
 import argparse
+import contextlib
 import minhash
 import privmin
 import bucket_privmin
 import sec_minhash
 import noisy_sec_minhash
+import simjoin
+import profiling
 
 
 
 
-def setup(file):
+def setup(file, top_N=None):
     
     data = dr.read_data(file) 
     data_size = len(data.keys()) 
-  
 
-    filename_JSim = 'JSims/'+ file.replace('.dat', '_truth.txt')
-    
-    # comment in when using an unknown data set
-    # preprocessing.set_initial_JSim(data, data_size, filename_JSim)
-    
+    # only the exact top N neighbours, for large sparse data sets whose full truth
+    # is too large; on small or dense data sets calc_JSim is faster (benchmark.py simjoin)
+    if top_N is not None:
+        return data, simjoin.top_N_neighbours(data, top_N)
+
+    filename_JSim = 'JSims/'+ os.path.splitext(file)[0] + '_truth.bin'
+    fingerprint = dr.file_fingerprint(dr.data_path(file))
+
+    # the truth is recomputed whenever the data file or its users have changed
+    if not preprocessing.is_current(filename_JSim, fingerprint, data.keys()):
+        preprocessing.set_initial_JSim(data, data_size, filename_JSim, fingerprint)
+
     JSim = preprocessing.set_JSim(data_size, filename_JSim)
     
     return data, JSim
 
  
-def hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets):
+def make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed=None, base_cache=None):
     next_prime = 2**31 -1
-    
 
     if 'privmin' == minhash_type.lower():
-        priv = privmin.PrivMin(num_hashes, data, eps)
-        user_to_sig = priv.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(priv, user_to_sig)
+        return privmin.PrivMin(num_hashes, data, eps, seed=seed, base_cache=base_cache)
 
     elif 'bucket' in minhash_type.lower():
-        bucket_priv = bucket_privmin.Bucket_PrivMin(num_hashes, data, eps, num_buckets, False)
-        user_to_sig = bucket_priv.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(bucket_priv, user_to_sig)
+        return bucket_privmin.Bucket_PrivMin(num_hashes, data, eps, num_buckets, False, seed=seed, base_cache=base_cache)
         
     elif 'sec_minhash' == minhash_type.lower():
-        sec_mh = sec_minhash.Sec_MinHash(num_hashes, data, l)
-        user_to_sig = sec_mh.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(sec_mh, user_to_sig)
+        return sec_minhash.Sec_MinHash(num_hashes, data, l, seed=seed)
 
     elif 'noisy' in minhash_type.lower():
-        noisy_sec = noisy_sec_minhash.Noisy_Sec_MinHash(num_hashes, data, eps, l, alpha, delta, b=b)
-        user_to_sig = noisy_sec.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(noisy_sec, user_to_sig)
-    
+        return noisy_sec_minhash.Noisy_Sec_MinHash(num_hashes, data, eps, l, alpha, delta, b=b, seed=seed)
 
     else:
-        reg_mh = minhash.MinHash(num_hashes, data)
-        user_to_sig = reg_mh.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(reg_mh, user_to_sig)
-    
+        return minhash.MinHash(num_hashes, data, seed=seed, base_cache=base_cache)
+
+
+def hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, workers=None, seed=None, base_cache=None):
+    MH_algo = make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed, base_cache)
+    user_to_sig = MH_algo.generate_minHash_sigs(workers)
+    estJSim = anal.set_estJSim(MH_algo, user_to_sig)
     return user_to_sig, estJSim
 
 
 
-def main(data, JSim, minhash_type, num_hashes, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None):
+def main(data, JSim, minhash_type, num_hashes, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None, workers=None, seed=None, base_cache=None):
 
-    user_to_sig, est_JSim = hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets)
+    user_to_sig, est_JSim = hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, workers, seed, base_cache)
 
     analysis = anal.Analysis(user_to_sig, JSim, est_JSim)
     
     return analysis
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-a', '--algorithm', type=int, 
-choices= [0,1,2,3,4], help="0 = MinHash, 1 = Secure MinHash, 2 = Bucket PrivMin, 3 = Noisy Secure MinHash, 4 = PrivMin")
-parser.add_argument('-k', '--hashes', type=int, help='Number of hash functions')
-parser.add_argument('-l', '--length', type=int, help='Length of signature in (Noisy) Secure MinHash')
-parser.add_argument('-e', '--epsilon', type=float, help='Privacy budget')
-parser.add_argument('-b', '--buckets', type=int, help='Number of buckets in Bucket PrivMin')
-parser.add_argument('-d', '--delta', type=float, help='Delta for Noisy Secure MinHash')
-parser.add_argument('-s', '--set', type=int, choices=[0,1], help='Dataset, 0 = MovieLens, 1 = Last.FM')
-
-args = parser.parse_args()
-
-K = args.hashes
-if args.set == 0:
-    filename = 'movielens.dat'
-elif args.set == 1:
-    filename = 'lastfm.dat'
-
-if args.algorithm == 0:
-    algorithm = ''
-    data,JSim = setup(filename)
-    ana = main(data, JSim, algorithm, K)
-elif args.algorithm == 1:
-    algorithm = 'sec_minhash'
-    l = args.length
-    data,JSim = setup(filename)
-    ana = main(data, JSim, algorithm, K, l=l)
-elif args.algorithm == 2:
-    algorithm = 'bucket'
-    eps = args.epsilon
-    num_buckets = args.buckets
-    data,JSim = setup(filename)
-    ana = main(data, JSim, algorithm, K, eps=eps, num_buckets=num_buckets)
-elif args.algorithm == 3:
-    algorithm = 'noisy'
-    l = args.length
-    eps = args.epsilon
-    delta = args.delta
-    data,JSim = setup(filename)
-    ana = main(data, JSim, algorithm, K, l=l, eps=eps, delta=delta, alpha=1)
-elif args.algorithm == 4:
-    algorithm = 'privmin'
-    eps = args.epsilon
-    data,JSim = setup(filename)
-    ana = main(data, JSim, algorithm, K, eps=eps)
-
-prec, rec, f1 = ana.PRF()
-mse = ana.MSE()
-print('Approximate Recall for Algorithm', args.algorithm, ' = ', rec)
-print('Mean Squared Error for Algorithm', args.algorithm, ' = ', mse)
-
-
-
-
-
-
-
-
-
-
+def trials(data, JSim, minhash_type, num_hashes, num_trials, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None, seed=None, confidence=0.95):
+    """Returns mean, standard deviation and confidence interval of each measure
+    over num_trials randomizations sharing the same hash functions."""
+    MH_algo = make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed)
+    return anal.run_trials(MH_algo, JSim, num_trials, confidence)
+
+
+# worker processes may import this module, so the CLI only runs as a script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--algorithm', type=int, 
+    choices= [0,1,2,3,4], help="0 = MinHash, 1 = Secure MinHash, 2 = Bucket PrivMin, 3 = Noisy Secure MinHash, 4 = PrivMin")
+    parser.add_argument('-k', '--hashes', type=int, help='Number of hash functions')
+    parser.add_argument('-l', '--length', type=int, help='Length of signature in (Noisy) Secure MinHash')
+    parser.add_argument('-e', '--epsilon', type=float, help='Privacy budget')
+    parser.add_argument('-b', '--buckets', type=int, help='Number of buckets in Bucket PrivMin')
+    parser.add_argument('-d', '--delta', type=float, help='Delta for Noisy Secure MinHash')
+    parser.add_argument('-s', '--set', type=int, choices=[0,1], help='Dataset, 0 = MovieLens, 1 = Last.FM')
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes generating signatures in shards')
+    parser.add_argument('-t', '--trials', type=int, help='Number of randomized trials; reports mean, std and confidence interval')
+    parser.add_argument('--profile', nargs='?', const='profile.json',
+                        help='Write time, memory and hot-path counters of each stage to a JSON file (default profile.json)')
+    parser.add_argument('--cprofile', help='Directory receiving a cProfile dump of each stage; implies --profile')
+
+    args = parser.parse_args()
+    if args.trials and args.workers is not None:
+        parser.error('-t generates the signatures of all trials in one process, it cannot be combined with -w')
+
+    K = args.hashes
+    if args.set == 0:
+        filename = 'movielens.dat'
+    elif args.set == 1:
+        filename = 'lastfm.dat'
+
+    if args.algorithm == 0:
+        algorithm = ''
+        params = {}
+    elif args.algorithm == 1:
+        algorithm = 'sec_minhash'
+        params = dict(l=args.length)
+    elif args.algorithm == 2:
+        algorithm = 'bucket'
+        params = dict(eps=args.epsilon, num_buckets=args.buckets)
+    elif args.algorithm == 3:
+        algorithm = 'noisy'
+        params = dict(l=args.length, eps=args.epsilon, delta=args.delta, alpha=1)
+    elif args.algorithm == 4:
+        algorithm = 'privmin'
+        params = dict(eps=args.epsilon)
+
+    profiler = None
+    if args.profile or args.cprofile:
+        profiler = profiling.Profiler(args.cprofile)
+
+    def stage(name):
+        return profiler.stage(name) if profiler else contextlib.nullcontext()
+
+    with stage('setup'):
+        data,JSim = setup(filename)
+
+    if args.trials:
+        with stage('trials'):
+            summary = trials(data, JSim, algorithm, K, args.trials, **params)
+        for measure, stats in summary.items():
+            print('%s for Algorithm %d over %d trials = %f (std %f, 95%% CI %f - %f)'
+                  % (measure, args.algorithm, args.trials, stats['mean'], stats['std'], stats['ci_low'], stats['ci_high']))
+    else:
+        with stage('hashing'):
+            MH_algo = make_algorithm(data, K, params.get('eps'), algorithm, params.get('l'), None,
+                                     params.get('alpha'), params.get('delta'), params.get('num_buckets'))
+            user_to_sig = MH_algo.generate_minHash_sigs(args.workers)
+        with stage('set_estJSim'):
+            est_JSim = anal.set_estJSim(MH_algo, user_to_sig)
+        with stage('Analysis'):
+            ana = anal.Analysis(user_to_sig, JSim, est_JSim)
+            prec, rec, f1 = ana.PRF()
+            mse = ana.MSE()
+        print('Approximate Recall for Algorithm', args.algorithm, ' = ', rec)
+        print('Mean Squared Error for Algorithm', args.algorithm, ' = ', mse)
+
+    if profiler:
+        report = args.profile or 'profile.json'
+        profiler.write(report, dataset=filename, algorithm=args.algorithm, args=vars(args))
+        print('Wrote profile to', report)
@@ -3,91 +3,278 @@ import math
 import statistics as stat
 import preprocessing as pr
 import datareader as dr
+import signatures as sg
+import simmatrix as sm
+import simjoin as sj
 
 # =============================================================================
 #                     Analysis
 # =============================================================================
 # Performs analysis on the performance of the algorithms.
 
+TRIAL_CELLS = 2**23  # bounds the signatures of a batch of trials and the estimates of a block
+
 class Analysis:
-    def __init__(self, user_to_sig, JSim, estJSim):
+    def __init__(self, user_to_sig, JSim, estJSim, tie_policy='index'):
         """N is true nearest neighbours, M is estimated nearest neighbours.
         Used for approximate recall.
+        A user is never its own neighbour. Ties at the k-th largest similarity
+        follow tie_policy: 'index' takes the tied users with the lowest index
+        so exactly k are selected, 'all' selects every tied user. Users of true
+        similarity 0 are never true neighbours, so a user sharing items with
+        fewer than N users has fewer true neighbours.
+        JSim may also be the exact top-N Neighbours of each user and estJSim
+        the estimated neighbours, e.g. from an LSH index. That is enough for
+        PRF but not for the error measures.
+        estJSim may hold the estimates of several trials, as EstimatedSims of a
+        stack of signature matrices; the measures are then arrays over trials.
         """
         self.user_to_sig = user_to_sig
         self.data_size = len(user_to_sig.keys())    
-        self.JSim = JSim
-        self.estJSim = estJSim
+        self.JSim = JSim if isinstance(JSim, sj.Neighbours) else sm.as_row_source(JSim)
+        self.estJSim = estJSim if isinstance(estJSim, sj.Neighbours) else sm.as_row_source(estJSim)
         self.N = 20
         self.M = 100
+        self.tie_policy = tie_policy
+        self.block_size = 256
 
 
     def MSE(self):
-        sq_error = 0
+        return self.errors()['MSE']
+
+
+    def errors(self, block_size=None, chunk_size=2**20):
+        """Returns mean squared error, mean absolute error and bias of the estimated
+        similarities over all pairs of users. Streams over blocks of the upper
+        triangle and accumulates in float64, so neither matrix has to be in memory."""
+        if not self.has_errors():
+            raise ValueError('Error measures need all similarities, not top-N neighbours')
+        sums = 0
         counter = 0
-        for i in range(len(self.JSim)):
-            for j in range(i+1, len(self.JSim)):
-                counter += 1
-                sq_error += (self.JSim[i][j]-self.estJSim[i][j])**2
-        return (sq_error/counter)
+        for truth, est in self.iter_upper_pairs(block_size or self.block_size, chunk_size):
+            sums = sums + error_sums(truth, est)
+            counter += truth.shape[-1]
+        return error_measures(sums, counter)
+
+
+    def has_errors(self):
+        return not isinstance(self.JSim, sj.Neighbours) and not isinstance(self.estJSim, sj.Neighbours)
+
+
+    def iter_upper_pairs(self, block_size, chunk_size):
+        """Yields matching chunks of true and estimated similarities of the pairs
+        (i, j) with i < j."""
+        if isinstance(self.JSim, sm.SimMatrix) and isinstance(self.estJSim, sm.SimMatrix):
+            for start in range(0, len(self.JSim.data), chunk_size):
+                yield self.JSim.data[start:start + chunk_size], self.estJSim.data[start:start + chunk_size]
+            return
+        blocks = zip(self.JSim.iter_blocks(block_size, upper=True), self.estJSim.iter_blocks(block_size, upper=True))
+        for (start, stop, true_rows), (_, _, est_rows) in blocks:
+            upper = np.arange(true_rows.shape[1])[None, :] > np.arange(stop - start)[:, None]
+            yield true_rows[upper], est_rows[..., upper]
+
+
+    def neighbour_counts(self, ks):
+        """Compares the top-k estimated neighbours for each k in ks with the top N
+        true neighbours of every user, a block of rows at a time. Returns the
+        summed true positives and selected neighbours per k and the number of
+        true neighbours."""
+        TPs = dict.fromkeys(ks, 0)
+        selected = dict.fromkeys(ks, 0)
+        num_true = 0
+        for start, stop, est_rows in self.iter_est_blocks():
+            true_mask = self.true_neighbours(start, stop)
+            num_true += int(true_mask.sum())
+            for k in ks:
+                est_mask = self.est_neighbours(start, stop, est_rows, k)
+                TPs[k] = TPs[k] + np.sum(est_mask & true_mask, axis=(-2, -1))
+                selected[k] = selected[k] + np.sum(est_mask, axis=(-2, -1))
+        return {k: unwrap(TPs[k]) for k in ks}, {k: unwrap(selected[k]) for k in ks}, num_true
+
+
+    def measures(self):
+        """Returns MSE, MAE, bias, precision, recall and F1 from a single pass
+        over the blocks of estimates, for estimates computed on demand. The
+        error measures are left out for top-N neighbours."""
+        with_errors = self.has_errors()
+        TP = selected = sums = 0
+        num_true = counter = 0
+        for start, stop, est_rows in self.iter_est_blocks():
+            true_rows = self.true_rows(start, stop) if with_errors else None
+            true_mask = self.true_neighbours(start, stop, true_rows)
+            est_mask = self.est_neighbours(start, stop, est_rows, self.M)
+            num_true += int(true_mask.sum())
+            TP = TP + np.sum(est_mask & true_mask, axis=(-2, -1))
+            selected = selected + np.sum(est_mask, axis=(-2, -1))
+            if with_errors:
+                upper = np.arange(true_rows.shape[1])[None, :] > np.arange(start, stop)[:, None]
+                sums = sums + error_sums(true_rows[upper], est_rows[..., upper])
+                counter += int(upper.sum())
+        prec, recall, f1 = prf(TP, selected, num_true)
+        measures = {'precision': prec, 'recall': recall, 'F1': f1}
+        if with_errors:
+            measures.update(error_measures(sums, counter))
+        return measures
+
+
+    def iter_est_blocks(self):
+        """Yields blocks of estimated similarities, or None for the rows when the
+        estimated neighbours are given directly."""
+        if not isinstance(self.estJSim, sj.Neighbours):
+            yield from self.estJSim.iter_blocks(self.block_size)
+            return
+        for start in range(0, len(self.estJSim), self.block_size):
+            yield start, min(start + self.block_size, len(self.estJSim)), None
+
+
+    def est_neighbours(self, start, stop, est_rows, k):
+        """Returns the mask of the top k estimated neighbours of users start..stop."""
+        if est_rows is None:
+            return self.estJSim.mask(start, stop, k)
+        return top_k_mask(est_rows, k, start, self.tie_policy)
+
+
+    def true_rows(self, start, stop):
+        if hasattr(self.JSim, 'rows'):
+            return self.JSim.rows(start, stop)
+        return np.asarray(self.JSim[start:stop])
+
+
+    def true_neighbours(self, start, stop, true_rows=None):
+        """Returns the mask of the top N true neighbours of users start..stop."""
+        if isinstance(self.JSim, sj.Neighbours):
+            return self.JSim.mask(start, stop, self.N)
+        if true_rows is None:
+            true_rows = self.true_rows(start, stop)
+        return top_k_mask(true_rows, self.N, start, self.tie_policy) & (np.asarray(true_rows) > 0)
+
+
+    def recall_at(self, ks):
+        """Returns the recall of the top N true neighbours among the top-k
+        estimated neighbours for each k in ks."""
+        TPs, _, num_true = self.neighbour_counts(ks)
+        return {k: TPs[k] / num_true for k in ks}
 
 
     def PRF(self):
         """Calculates precision, recall, and F1 score."""
-        TP = 0
-        FP = 0
-        FN = 0
-        
-        for i in range(self.data_size):
-
-            # Get estimated neighbours
-            neigh = np.asarray(self.estJSim[i])
-            index_neigh = list(neigh.argsort()[-self.M:][::-1])
-
-            # Get true neighbours
-            real_neigh = np.asarray(self.JSim[i])
-            real_index_neigh = list(real_neigh.argsort()[-self.N:][::-1])
-
-            for neighbour in index_neigh:
-                if neighbour in real_index_neigh:
-                    TP += 1
-                else:
-                    FP += 1
-            for n in real_index_neigh:
-                if n not in index_neigh:
-                    FN += 1
-
-        prec = TP / (FP+TP)
-        recall = TP / (TP + FN)
-        if prec == 0:
-            prec = 1
-        if recall == 0:
-            recall = 1
-        f1 = (2 * prec * recall) / (prec + recall)
-        return prec, recall, f1
+        TPs, selected, num_true = self.neighbour_counts([self.M])
+        return prf(TPs[self.M], selected[self.M], num_true)
+
+
+def prf(TP, selected, num_true):
+    """Returns precision, recall and F1 score from neighbour counts, elementwise
+    for counts of several trials."""
+    FP = selected - TP
+    FN = num_true - TP
+
+    prec = TP / (FP+TP)
+    recall = TP / (TP + FN)
+    prec = np.where(prec == 0, 1, prec)
+    recall = np.where(recall == 0, 1, recall)
+    f1 = (2 * prec * recall) / (prec + recall)
+    return unwrap(prec), unwrap(recall), unwrap(f1)
+
+
+def error_sums(truth, est):
+    """Returns the summed squared, absolute and signed errors of estimates of
+    the same pairs, along the last axis."""
+    diff = est.astype(np.float64) - truth.astype(np.float64)
+    return np.stack((np.square(diff).sum(axis=-1), np.abs(diff).sum(axis=-1), diff.sum(axis=-1)))
+
+
+def error_measures(sums, counter):
+    sq_error, abs_error, error = sums / counter
+    return {'MSE': unwrap(sq_error), 'MAE': unwrap(abs_error), 'bias': unwrap(error)}
+
 
+def unwrap(value):
+    """Returns a single measure as a Python number and per-trial measures as an
+    array."""
+    return value.item() if np.ndim(value) == 0 else value
+
+
+
+def top_k_mask(rows, k, start, tie_policy='index'):
+    """Returns a boolean mask of the k largest similarities in each row of a block
+    of rows beginning at row start, leaving out the diagonal. Uses partial
+    selection to find the k-th largest value of every row. Blocks of several
+    trials are stacked along leading axes."""
+    rows = np.array(rows, dtype=np.promote_types(np.asarray(rows).dtype, np.float32))
+    num_rows, size = rows.shape[-2:]
+    rows[..., np.arange(num_rows), start + np.arange(num_rows)] = -np.inf
+    k = min(k, size - 1)
+    if k <= 0:
+        return np.zeros(rows.shape, dtype=bool)
+    kth = np.partition(rows, size - k, axis=-1)[..., size - k][..., None]
+    if tie_policy == 'all':
+        return (rows >= kth) & (rows > -np.inf)
+    above = rows > kth
+    tied = rows == kth
+    missing = k - above.sum(axis=-1, keepdims=True)
+    if np.all(tied.sum(axis=-1, keepdims=True) == missing):
+        return above | tied
+    return above | (tied & (np.cumsum(tied, axis=-1) <= missing))
 
 
 def set_estJSim(MH_algo, user_to_sig):
     """Generates a matrix of estimated similarities."""
 
-    estJSim = [[0 for x in range(MH_algo.data_size)] for y in range(MH_algo.data_size)]
-    id_to_idx = MH_algo.id_to_idx
-
-    for counter, user in enumerate(user_to_sig.keys()):
-        id_to_idx[user] = counter
-        for other_counter, other_user in enumerate(user_to_sig.keys()):
-            if user == other_user:
-                continue
-            if counter > other_counter:
-                estJSim[counter][other_counter] = estJSim[other_counter][counter]
-                continue
-            id_to_idx[other_user] = other_counter
-            estJSim[counter][other_counter] = MH_algo.calc_est_Jacc(user_to_sig[user], user_to_sig[other_user])
+    estJSim, id_to_idx = MH_algo.calc_est_Jacc_matrix(user_to_sig)
+    MH_algo.id_to_idx = id_to_idx
     return estJSim
 
 
+def trial_measures(MH_algo, trial_sigs, JSim, N=20, M=100, tie_policy='index'):
+    """Returns MSE, MAE, bias, precision, recall and F1 of every trial as arrays,
+    given (trials x n_users x length) signatures or an iterable of such arrays
+    for batches of trials. Analysis measures the estimates of each batch in
+    one pass, computing the estimates of a block of users for all trials of
+    the batch at once. Error measures are left out if JSim holds only top-N
+    neighbours."""
+    if isinstance(trial_sigs, np.ndarray):
+        trial_sigs = [trial_sigs]
+    batches = []
+    for sigs in trial_sigs:
+        trials, size = sigs.shape[:2]
+        if trials > 1 and sigs.strides[0] == 0:
+            # deterministic algorithms repeat the same signatures in every trial
+            sigs = sigs[:1]
+        user_to_sig = sg.Signatures(range(size), sigs)
+        analysis = Analysis(user_to_sig, JSim, sm.EstimatedSims(MH_algo, user_to_sig), tie_policy)
+        analysis.N, analysis.M = N, M
+        analysis.block_size = max(1, TRIAL_CELLS // (len(sigs) * size))
+        measures = analysis.measures()
+        batches.append({name: np.broadcast_to(np.atleast_1d(values), trials) for name, values in measures.items()})
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+
+
+def summarize_trials(measures, confidence=0.95):
+    """Returns mean, standard deviation and the normal confidence interval of the
+    mean of every measure over the trials."""
+    z = stat.NormalDist().inv_cdf(0.5 + confidence / 2)
+    summary = {}
+    for name, values in measures.items():
+        mean = float(np.mean(values))
+        std = float(np.std(values, ddof=1)) if len(values) > 1 else 0.0
+        half = z * std / math.sqrt(len(values))
+        summary[name] = {'mean': mean, 'std': std, 'ci_low': mean - half, 'ci_high': mean + half}
+    return summary
+
+
+def run_trials(MH_algo, JSim, trials, confidence=0.95, N=20, M=100):
+    """Runs trials independent randomizations of an algorithm on shared hash
+    functions and returns the summarized measures. The trials are generated
+    and measured in batches of at most TRIAL_CELLS signature entries."""
+    length = getattr(MH_algo, 'L', MH_algo.num_hashes)
+    batch = max(1, TRIAL_CELLS // (MH_algo.data_size * length))
+    trial_sigs = MH_algo.iter_trial_sigs(trials, batch)
+    return summarize_trials(trial_measures(MH_algo, trial_sigs, JSim, N, M), confidence)
+
+
 def get_avg_sim(JSim):
+    if isinstance(JSim, sm.SimMatrix):
+        return JSim.data.mean(dtype=np.float64)
     sim = 0
     count = 0
     for i in range(len(JSim)-1):
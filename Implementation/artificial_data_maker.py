@@ -1,87 +1,164 @@
-import random
+import argparse
+import numpy as np
+import scipy.sparse
 import datareader as dr
-import preprocessing as pr 
-import main
 
 # =============================================================================
 #                 Generate Artificial Data Sets
 # =============================================================================
-# Script to generate artificial data sets and write them to a text file.
+# Generates artificial data sets and writes them to binary dataset files.
+# Item sets are sampled without replacement for all users at once: items are
+# drawn with replacement, duplicates within a user are removed and only the
+# missing items of unfinished users are drawn again. Items are uniform or
+# follow a Zipf law, and users may be split into clusters that draw from
+# disjoint parts of the universe. The average similarity is estimated from a
+# sample of pairs.
+
+SIM_PAIRS = 100000  # pairs sampled to estimate the average similarity
+
+
+def zipf_probs(universe_size, exponent):
+    """Returns the probabilities of items 0..universe_size under a Zipf law,
+    item i having weight 1 / (i + 1)**exponent."""
+    weights = 1.0 / np.arange(1, universe_size + 2) ** exponent
+    return weights / weights.sum()
+
+
+def sample_sets(sizes, width, rng, probs=None):
+    """Samples sizes[u] distinct items from 0..width for every user u, with the
+    given item probabilities or uniformly. Returns the sorted keys
+    u * (width + 1) + item of all drawn items."""
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if np.any(sizes > width + 1):
+        raise ValueError('Set sizes exceed the number of items to draw from')
+    done = np.zeros(0, dtype=np.int64)
+    pending = np.zeros(0, dtype=np.int64)
+    missing = sizes.copy()
+    while True:
+        users = np.flatnonzero(missing)
+        if len(users) == 0:
+            break
+        new_rows = np.repeat(users, missing[users])
+        if probs is None:
+            new_items = rng.integers(0, width + 1, size=len(new_rows))
+        else:
+            new_items = rng.choice(width + 1, size=len(new_rows), p=probs)
+        keys = np.sort(np.concatenate((pending, new_rows * (width + 1) + new_items)))
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+        rows = keys // (width + 1)
+        missing[users] = sizes[users] - np.bincount(rows, minlength=len(sizes))[users]
+        complete = missing[rows] == 0
+        done = np.concatenate((done, keys[complete]))
+        pending = keys[~complete]
+    return np.sort(done)
+
+
+def keys_to_dataset(keys, data_size, width, offsets=None):
+    """Builds a Dataset of users 1..data_size from sorted keys of sample_sets,
+    shifting the items of user u by offsets[u]."""
+    rows = keys // (width + 1)
+    items = keys % (width + 1)
+    if offsets is not None:
+        items += offsets[rows]
+    present = np.zeros(int(items.max()) + 1 if len(items) else 0, dtype=bool)
+    present[items] = True
+    dense = np.cumsum(present) - 1
+    indptr = np.zeros(data_size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=data_size), out=indptr[1:])
+    return dr.Dataset(np.arange(1, data_size + 1), indptr, dense[items], np.flatnonzero(present))
+
+
+def universe_of(user_size, density):
+    """Returns the number of items of a universe of user_size/density items,
+    rounded so that the density computed from a universe gives it back."""
+    return int(round(user_size/density))
+
+
+def make_data_set(data_size, user_size, density, zipf=None, seed=None):
+    """Returns a Dataset of data_size users with 1 to 4 times user_size items
+    from a universe of user_size/density items. Items are uniform, or follow a
+    Zipf law with the given exponent."""
+    rng = np.random.default_rng(seed)
+    universe_size = universe_of(user_size, density)
+    sizes = rng.integers(1, 5, size=data_size) * user_size
+    probs = zipf_probs(universe_size, zipf) if zipf else None
+    return keys_to_dataset(sample_sets(sizes, universe_size, rng, probs), data_size, universe_size)
+
+
+def make_clust_data_set(data_size, user_size, density, clusters, zipf=None, seed=None):
+    """Like make_data_set, but splits the universe into clusters equal ranges
+    and the users into clusters equal groups; each group draws its items only
+    from its own range."""
+    rng = np.random.default_rng(seed)
+    universe_size = universe_of(user_size, density)
+    width = universe_size // clusters - 1
+    sizes = rng.integers(1, 5, size=data_size) * user_size
+    cluster = np.arange(data_size) * clusters // data_size
+    probs = zipf_probs(width, zipf) if zipf else None
+    keys = sample_sets(sizes, width, rng, probs)
+    return keys_to_dataset(keys, data_size, width, offsets=cluster * (width + 1))
+
+
+def estimate_avg_simi(data, num_pairs=SIM_PAIRS, seed=None):
+    """Returns the average Jaccard similarity over all pairs of users. Data sets
+    with more than num_pairs pairs are estimated from num_pairs random pairs."""
+    data = dr.as_dataset(data)
+    n = data.num_users
+    if n * (n - 1) // 2 <= num_pairs:
+        first, second = np.triu_indices(n, k=1)
+    else:
+        rng = np.random.default_rng(seed)
+        first = rng.integers(0, n, size=num_pairs)
+        second = rng.integers(0, n - 1, size=num_pairs)
+        second += second >= first
+    ones = np.ones(len(data.indices), dtype=np.float32)
+    users = scipy.sparse.csr_matrix((ones, data.indices, data.indptr), shape=(n, data.num_items))
+    intersection = np.asarray(users[first].multiply(users[second]).sum(axis=1)).ravel()
+    union = data.set_sizes[first] + data.set_sizes[second] - intersection
+    return float(np.mean(intersection / union))
 
 
-def make_data_set(data_size, user_size, density):
-
-    universe_size = int(user_size/density)
-    data = [[] for _ in range(data_size)]
-    
-    for i in range(data_size):
-        size = random.randint(1,4) * user_size
-        for j in range(size):
-            val = random.randint(0, universe_size)
-            while val in data[i]:
-                val = random.randint(0, universe_size)
-            data[i].append(val)
-    
-    return data
-
-
-def make_clust_data_set(data_size, user_size, density, clusters):
-    
-    universe_size = int(user_size/density)
-    data = [[] for _ in range(data_size)]
-
-    min_lim = 0
-    max_lim = int(universe_size/clusters)
-    elements_per_cluster = int(data_size/clusters)
+def get_avg_simi(data):
+    """Returns the exact average Jaccard similarity over all pairs of users."""
+    data = dr.as_dataset(data)
+    return estimate_avg_simi(data, num_pairs=data.num_users * (data.num_users - 1) // 2)
 
-    counter = 0
-    for i in range(clusters):
-        for j in range(elements_per_cluster):
-            val = random.randint(min_lim, max_lim)
-            data[counter].append(val)
-        min_lim = max_lim
-        max_lim += int(universe_size/clusters)
-    
-    return data
 
+def write_dataset(data, filename, size, simi):
+    """Writes a Dataset to the binary dataset format with the universe size and
+    average similarity."""
+    dr.save_dataset(filename, data, universe_size=size, avg_sim=simi)
 
-def get_avg_simi(data):
-    avg_sim = 0
-    counter = 0
-    for i in range(len(data)):
-        for j in range(i+1, len(data)):
-            jac = pr.calc_Jacc(data[i], data[j])
-            avg_sim += jac
-            counter += 1
-    return avg_sim/counter
 
 def write_to_file(data, filename, size, simi):
+    """Writes the item sets to the text format of read_artificial_data."""
+    item_sets = data.values() if isinstance(data, dr.Dataset) else data
     with open(filename, 'w') as f:
         f.write(str(size) + ',' + str(simi) + '\n')
-        for i in range(len(data)):
-            for j in range(len(data[i])):
-                f.write(str(data[i][j]))
-                if not j == len(data[i]) -1:
-                    f.write(',')
-            if not i == len(data) -1:
-                f.write('\n')
-
-user_size = 20
-data_size = 2000
-densities = [0.2, 0.1, 0.01, 0.0001]
-for dens in densities:
-    data = make_data_set(data_size, user_size, dens)
-    size = int(user_size/dens)
-    simi = get_avg_simi(data)
-    filename = 'input_data/Artificial_data/artificial_data_' + str(size) + '.dat'
-    write_to_file(data, filename, size, simi)
-    truth_file_name = 'Artificial_data/artificial_data_' + str(size) + '.dat'
-    data, JSim = main.setup(truth_file_name)
-    
-
-
-    
-        
-
-
-
+        f.write('\n'.join(','.join(str(item) for item in items) for items in item_sets))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates artificial data sets in input_data/Artificial_data/.')
+    parser.add_argument('-n', '--users', type=int, default=2000, help='Number of users')
+    parser.add_argument('-z', '--set-size', type=int, default=20, help='Base set size (sets have 1 to 4 times the size)')
+    parser.add_argument('-d', '--densities', type=float, nargs='+', default=[0.2, 0.1, 0.01, 0.0001],
+                        help='Set size divided by universe size, one data set each')
+    parser.add_argument('-p', '--zipf', type=float, help='Zipf exponent of the item popularity')
+    parser.add_argument('-c', '--clusters', type=int, help='Number of user clusters')
+    parser.add_argument('-s', '--seed', type=int, help='Seed of the generator')
+    parser.add_argument('-t', '--text', action='store_true', help='Also write the text format')
+    args = parser.parse_args()
+
+    for dens in args.densities:
+        if args.clusters:
+            data = make_clust_data_set(args.users, args.set_size, dens, args.clusters, args.zipf, args.seed)
+        else:
+            data = make_data_set(args.users, args.set_size, dens, args.zipf, args.seed)
+        size = universe_of(args.set_size, dens)
+        simi = estimate_avg_simi(data, seed=args.seed)
+        filename = 'input_data/Artificial_data/artificial_data_' + str(size)
+        write_dataset(data, filename + '.npz', size, simi)
+        if args.text:
+            write_to_file(data, filename + '.dat', size, simi)
+        print('Wrote', filename, 'with average similarity', simi)
@@ -0,0 +1,166 @@
+import collections
+import hashlib
+import os
+import numpy as np
+
+# =============================================================================
+#                 Base Hash Cache
+# =============================================================================
+# MinHash, PrivMin and Bucket PrivMin all start from the same hash values of
+# each user's items and differ only in the value they report per cell. The
+# sorted smallest hash values of every user and hash function are computed
+# once and kept in a size-bounded LRU cache, in memory and optionally on disk,
+# keyed by the dataset and the hash functions. A sweep over eps or the number
+# of buckets then only repeats the randomization.
+
+MAX_BLOCK_CELLS = 2**22  # bounds the hash values gathered at once
+
+
+class BaseHashes:
+    """The lengths[u] smallest hash values of each user u in ascending order,
+    stored as values[offsets[u]:offsets[u] + lengths[u]] (each a row of k
+    values, one per hash function)."""
+
+    def __init__(self, lengths, values):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(self.lengths), dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=self.offsets[1:])
+        self.values = values
+        self.nbytes = self.values.nbytes + self.lengths.nbytes + self.offsets.nbytes
+
+    @property
+    def mins(self):
+        """Returns the (n_users x k) matrix of minimum hash values."""
+        return self.values[self.offsets]
+
+    def covers(self, lengths):
+        return len(lengths) == len(self.lengths) and bool(np.all(self.lengths >= lengths))
+
+    def iter_length_groups(self, lengths):
+        """Yields (length, rows, vals) for blocks of users with equal requested
+        length, vals being their (block x length x k) smallest hash values."""
+        order = np.argsort(lengths, kind='stable')
+        bounds = np.flatnonzero(np.diff(lengths[order])) + 1
+        for rows in np.split(order, bounds):
+            if len(rows) == 0:
+                continue
+            length = int(lengths[rows[0]])
+            block = max(1, MAX_BLOCK_CELLS // max(1, length * self.values.shape[1]))
+            for start in range(0, len(rows), block):
+                block_rows = rows[start:start + block]
+                yield length, block_rows, self.values[self.offsets[block_rows][:, None] + np.arange(length)]
+
+
+def compute_base_hashes(hashes, users, lengths):
+    """Returns the BaseHashes of a Dataset given the hashes of its distinct items
+    (num_items x k), keeping the lengths[u] smallest values of user u."""
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), users.set_sizes)
+    if np.any(lengths < 1):
+        raise ValueError('Base hashes need non-empty item sets')
+    values = np.empty((int(lengths.sum()), hashes.shape[1]), dtype=hashes.dtype)
+    base = BaseHashes(lengths, values)
+    sizes = users.set_sizes
+    order = np.argsort(sizes, kind='stable')
+    bounds = np.flatnonzero(np.diff(sizes[order])) + 1
+    for rows in np.split(order, bounds):
+        if len(rows) == 0:
+            continue
+        size = int(sizes[rows[0]])
+        block = max(1, MAX_BLOCK_CELLS // max(1, size * hashes.shape[1]))
+        for start in range(0, len(rows), block):
+            block_rows = rows[start:start + block]
+            vals = hashes[users.indices[users.indptr[block_rows][:, None] + np.arange(size)]]
+            block_lengths = lengths[block_rows]
+            length = int(block_lengths.max())
+            if length < size:
+                vals = np.partition(vals, length - 1, axis=1)[:, :length]
+            vals = np.sort(vals, axis=1)
+            keep = np.arange(length)[None, :] < block_lengths[:, None]
+            targets = base.offsets[block_rows][:, None] + np.arange(length)
+            values[targets[keep]] = vals[keep]
+    return base
+
+
+def base_hash_key(users, coeffA, coeffB, highest_ID, prime):
+    """Returns the cache key of a Dataset hashed with the given hash functions."""
+    digest = hashlib.sha1()
+    for array in (users.indptr, users.indices, users.item_ids):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(np.asarray(coeffA, dtype=np.int64).tobytes())
+    digest.update(np.asarray(coeffB, dtype=np.int64).tobytes())
+    digest.update(str((highest_ID, prime)).encode())
+    return digest.hexdigest()
+
+
+class BaseHashCache:
+    """LRU cache of BaseHashes holding at most max_bytes in memory. If a
+    directory is given, entries are also written there as .npz files and the
+    least recently used files are removed beyond max_disk_bytes."""
+
+    def __init__(self, max_bytes=2**28, directory=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, lengths, compute):
+        """Returns BaseHashes of the key with at least the given lengths, calling
+        compute(lengths) if neither memory nor disk has them."""
+        base = self.entries.get(key)
+        if base is None and self.directory is not None:
+            base = self.load(key)
+        if base is not None and base.covers(lengths):
+            self.hits += 1
+            self.store(key, base)
+            return base
+        self.misses += 1
+        if base is not None:
+            lengths = np.maximum(lengths, base.lengths)
+        base = compute(lengths)
+        self.store(key, base)
+        if self.directory is not None:
+            self.save(key, base)
+        return base
+
+    def store(self, key, base):
+        """Puts an entry in memory as the most recently used one and evicts the
+        least recently used entries over the size limit."""
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        if base.nbytes > self.max_bytes:
+            return
+        self.entries[key] = base
+        self.nbytes += base.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        try:
+            with np.load(self.path(key)) as cached:
+                base = BaseHashes(cached['lengths'], cached['values'])
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(self.path(key))
+        return base
+
+    def save(self, key, base):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path(key) + '.tmp.npz'
+        np.savez(tmp_path, lengths=base.lengths, values=base.values)
+        os.replace(tmp_path, self.path(key))
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.npz')]
+        files.sort(key=lambda f: os.stat(f).st_mtime_ns)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            total -= os.path.getsize(f)
+            os.remove(f)
@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import analysis as anal
+import artificial_data_maker as adm
+import datareader as dr
+import main
+import preprocessing
+import simjoin
+
+# =============================================================================
+#                 Benchmarks
+# =============================================================================
+# Times every stage of the pipeline on generated datasets of growing size and
+# records the peak memory allocated during the stage: reading the data file,
+# the true similarities, and for each algorithm the signatures, the estimated
+# similarities and the analysis. Results are written to JSON; two result files
+# can be compared to flag stages that became slower or use more memory.
+# Time and memory are measured in separate runs. Generating the datasets and
+# their true similarities needs SciPy besides NumPy.
+# The simjoin command times the exact top-N neighbours of simjoin against the
+# full similarities on a large sparse dataset, the case setup(top_N=...) is
+# meant for, and fails if the similarity join is not faster.
+
+ALGORITHMS = {
+    'minhash': {},
+    'privmin': {'eps': 1.0},
+    'bucket': {'eps': 2.0, 'num_buckets': 10},
+    'sec_minhash': {},
+    'noisy': {'eps': 2.0, 'delta': 0.1, 'alpha': 1},
+}
+SECURE = ['sec_minhash', 'noisy']
+
+
+def measure(func, repeat=1):
+    """Runs func repeat times and returns its last result and the fastest wall
+    time, with the peak of memory allocated through tracemalloc in one extra
+    run. Tracing slows down allocations, so it is kept out of the timed runs."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def make_dataset_file(directory, num_users, set_size, universe, seed):
+    """Generates an artificial dataset with artificial_data_maker and writes it
+    in the artificial text format. Returns the file name."""
+    data = adm.make_data_set(num_users, set_size, set_size / universe, seed=seed)
+    filename = os.path.join(directory, 'artificial_bench_%d_%d_%d.dat' % (num_users, set_size, universe))
+    adm.write_to_file(data, filename, universe, 0)
+    return filename
+
+
+def bench_dataset(directory, point, grid, algorithms, repeat, seed):
+    """Runs all stages on one generated dataset and returns result records.
+    (Priv)MinHash and Bucket PrivMin run for every k of the grid, (Noisy)
+    Secure MinHash for every L."""
+    records = []
+
+    def record(stage, algorithm, params, seconds, peak):
+        records.append(dict(point, **params, stage=stage, algorithm=algorithm, seconds=seconds, peak_bytes=peak))
+        print('%-50s %-12s %-10s %-10s %9.4f s %12d B' % (point, algorithm or '-', params or '', stage, seconds, peak))
+
+    filename = make_dataset_file(directory, point['users'], point['set_size'], point['universe'], seed)
+    data, seconds, peak = measure(lambda: dr.bulk_artificial_data(filename), repeat)
+    record('load', None, {}, seconds, peak)
+    JSim, seconds, peak = measure(lambda: preprocessing.calc_JSim(data, workers=1), repeat)
+    record('truth', None, {}, seconds, peak)
+    _, seconds, peak = measure(lambda: simjoin.top_N_neighbours(data, grid['top_N']), repeat)
+    record('top_N', None, {}, seconds, peak)
+    os.remove(filename)
+
+    for algorithm in algorithms:
+        settings = [{'L': L} for L in grid['L']] if algorithm in SECURE else [{'k': k} for k in grid['k']]
+        for params in settings:
+            args = dict(ALGORITHMS[algorithm])
+            num_hashes = grid['sec_k'] if algorithm in SECURE else params['k']
+            MH_algo = main.make_algorithm(data, num_hashes, args.get('eps'), algorithm, params.get('L'), None,
+                                          args.get('alpha'), args.get('delta'), args.get('num_buckets'), seed)
+            user_to_sig, seconds, peak = measure(MH_algo.generate_minHash_sigs, repeat)
+            record('signatures', algorithm, params, seconds, peak)
+            estJSim, seconds, peak = measure(lambda: anal.set_estJSim(MH_algo, user_to_sig), repeat)
+            record('estimates', algorithm, params, seconds, peak)
+            analysis = anal.Analysis(user_to_sig, JSim, estJSim)
+            _, seconds, peak = measure(analysis.MSE, repeat)
+            record('MSE', algorithm, params, seconds, peak)
+            _, seconds, peak = measure(analysis.PRF, repeat)
+            record('PRF', algorithm, params, seconds, peak)
+    return records
+
+
+def run(grid, algorithms, repeat=1, seed=0):
+    """Runs the benchmark on a dataset for every combination of users, set_size
+    and universe in the grid and returns the report with information about the
+    machine."""
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for users, set_size, universe in itertools.product(grid['users'], grid['set_size'], grid['universe']):
+            point = {'users': users, 'set_size': set_size, 'universe': universe}
+            if universe < 4 * set_size:
+                print('Skipping', point, '- the universe must hold 4 times the set size')
+                continue
+            records += bench_dataset(directory, point, grid, algorithms, repeat, seed)
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    return {'meta': meta, 'grid': grid, 'repeat': repeat, 'seed': seed, 'results': records}
+
+
+def check_simjoin(num_users, set_size, universe, N, seed=0):
+    """Times the exact top N neighbours of simjoin and the full similarities of
+    calc_JSim on a generated dataset and returns both times."""
+    data = adm.make_data_set(num_users, set_size, set_size / universe, seed=seed)
+    start = time.perf_counter()
+    simjoin.top_N_neighbours(data, N)
+    join_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    preprocessing.calc_JSim(data, workers=1)
+    full_seconds = time.perf_counter() - start
+    return join_seconds, full_seconds
+
+
+def record_key(record):
+    return tuple(sorted((name, value) for name, value in record.items() if name not in ('seconds', 'peak_bytes')))
+
+
+def compare(old, new, tolerance=0.2, min_seconds=0.005, min_bytes=2**16):
+    """Returns the records of new whose time or peak memory grew by more than
+    tolerance relative to the matching record of old. Growth below min_seconds
+    or min_bytes is treated as noise."""
+    old_records = {record_key(record): record for record in old['results']}
+    regressions = []
+    for record in new['results']:
+        before = old_records.get(record_key(record))
+        if before is None:
+            continue
+        slower = (record['seconds'] > before['seconds'] * (1 + tolerance)
+                  and record['seconds'] - before['seconds'] > min_seconds)
+        larger = (record['peak_bytes'] > before['peak_bytes'] * (1 + tolerance)
+                  and record['peak_bytes'] - before['peak_bytes'] > min_bytes)
+        if slower or larger:
+            regressions.append({'key': dict(record_key(record)),
+                                'seconds': (before['seconds'], record['seconds']),
+                                'peak_bytes': (before['peak_bytes'], record['peak_bytes'])})
+    return regressions
+
+
+def int_list(text):
+    return [int(v) for v in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of all algorithms on artificial data.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    bench = commands.add_parser('run', help='Run the benchmark')
+    bench.add_argument('-n', '--users', type=int_list, default=[500, 1000], help='Numbers of users, e.g. 500,1000')
+    bench.add_argument('-z', '--set-size', type=int_list, default=[20], help='Base set sizes (sets have 1 to 4 times the size)')
+    bench.add_argument('-u', '--universe', type=int_list, default=[1000], help='Numbers of possible items')
+    bench.add_argument('-k', '--hashes', type=int_list, default=[100], help='Hash functions of (Priv)MinHash and Bucket PrivMin')
+    bench.add_argument('-l', '--length', type=int_list, default=[256], help='Signature lengths of (Noisy) Secure MinHash')
+    bench.add_argument('--sec-hashes', type=int, default=5, help='Minimum values per bit in (Noisy) Secure MinHash')
+    bench.add_argument('-N', '--top-n', type=int, default=20, help='Neighbours per user of the top_N stage')
+    bench.add_argument('-a', '--algorithms', nargs='+', default=list(ALGORITHMS), choices=list(ALGORITHMS))
+    bench.add_argument('-r', '--repeat', type=int, default=1, help='Repetitions per stage, the fastest is kept')
+    bench.add_argument('-o', '--output', default='benchmark.json', help='JSON file of the results')
+    diff = commands.add_parser('compare', help='Flag regressions between two result files')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('-t', '--tolerance', type=float, default=0.2, help='Allowed relative growth')
+    join = commands.add_parser('simjoin', help='Check that the top-N similarity join beats the full similarities')
+    join.add_argument('-n', '--users', type=int, default=30000, help='Number of users')
+    join.add_argument('-z', '--set-size', type=int, default=20, help='Base set size (sets have 1 to 4 times the size)')
+    join.add_argument('-u', '--universe', type=int, default=200000, help='Number of possible items')
+    join.add_argument('-N', '--top-n', type=int, default=20, help='Neighbours per user')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        grid = {'users': args.users, 'set_size': args.set_size, 'universe': args.universe,
+                'k': args.hashes, 'L': args.length, 'sec_k': args.sec_hashes, 'top_N': args.top_n}
+        report = run(grid, args.algorithms, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Wrote', args.output)
+    elif args.command == 'simjoin':
+        join_seconds, full_seconds = check_simjoin(args.users, args.set_size, args.universe, args.top_n)
+        print('top %d neighbours %.2f s, full similarities %.2f s' % (args.top_n, join_seconds, full_seconds))
+        sys.exit(0 if join_seconds < full_seconds else 1)
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression['key'], 'seconds %.4f -> %.4f' % regression['seconds'],
+                  'peak %d -> %d bytes' % regression['peak_bytes'])
+        print('%d regressions' % len(regressions))
+        sys.exit(1 if regressions else 0)
@@ -1,66 +1,89 @@
 import math
 import random
-import datareader as dr
+import numpy as np
+import minhash as mh
 import privmin as pm
+import profiling as prof
 
 # =============================================================================
 #                 Generate Signatures with Bucket PrivMin
 # =============================================================================
-# Maps all possible hash values to buckets. Returns the bucket containing
+# Maps all possible hash values to buckets with a keyed random bijection of the
+# hash value universe, evaluated on arrays without materializing the universe.
+# Returns the bucket containing
 # possibly the minimum hash value based on a randomizing algorithm.
 # Uses by default the generalized random response, but can be set to use
-# the exponential mechanism inherited from the PrivMin.
+# the exponential mechanism inherited from the PrivMin. Signatures of all users
+# are randomized in one pass over the matrix of true minimum buckets.
 
 class Bucket_PrivMin(pm.PrivMin):
-  def __init__(self, num_hashes, users, eps, num_buckets, exp_mech):
-      pm.PrivMin.__init__(self, num_hashes, users, eps / num_hashes)
-      self.universe = dr.get_max_ID(users)
+  def __init__(self, num_hashes, users, eps, num_buckets, exp_mech, seed=None, base_cache=None):
+      pm.PrivMin.__init__(self, num_hashes, users, eps / num_hashes, seed, base_cache)
+      self.universe = self.users.max_ID
       self.range = int(num_buckets)
-      self.buckets = self.shrink_output_range()
-      self.val_to_buck = self.make_buck_idx()
+      self.buck_key = None
       self.exp_mech = exp_mech
 
 
+  def setup(self):
+    """Draws the hash functions like MinHash, so both share base hashes for a
+    seed, and then the bucket mapping."""
+    mh.MinHash.setup(self)
+    self.buck_key = self.shrink_output_range()
+
+
   def get_min_hash_val(self, hash_vals):
     """ Returns bucket containing possibly the minimum hash value.
     Uses either RR or the Exponential Mechanism based on the value of the boolean exp_mech
     """
     min_val = min(hash_vals)
-    min_buck = self.val_to_buck[min_val]   
+    min_buck = int(self.get_bucket(min_val))
 
-    if self.exp_mech:
-      util = self.util(hash_vals, min_val)
-      delta_util = 1
-      prob_sum = self.get_exp_sum(hash_vals, delta_util)
-      prob = self.apply_exp_mech(util, delta_util)
-    else:
-      prob_sum = 1
-      prob = self.apply_RR()
-    if self.is_chosen(prob, prob_sum):
+    if self.is_chosen(self.keep_prob(), 1):
       return min_buck
     else:
       return self.random_bucket(min_buck)
 
 
+  def keep_prob(self):
+    """Returns the probability of reporting the bucket of the minimum hash value."""
+    if self.exp_mech:
+      delta_util = 1
+      return self.apply_exp_mech(1, delta_util) / self.get_exp_sum(None, delta_util)
+    return self.apply_RR()
+
+
+  def randomize_buckets(self, min_bucks, rng):
+    """Applies the randomizing algorithm to a matrix of true minimum buckets
+    at once. A replaced bucket is drawn uniformly from the other buckets."""
+    if self.range == 1:
+      return min_bucks
+    keep = rng.random(min_bucks.shape) < self.keep_prob()
+    others = rng.integers(0, self.range - 1, size=min_bucks.shape)
+    others += (others >= min_bucks)
+    prof.count('grr_redraws', int(np.count_nonzero(~keep)))
+    return np.where(keep, min_bucks, others)
+
+
   def shrink_output_range(self):
-    """Maps all possible hash values to the number of buckets
-    defined by the range.
+    """Draws the key of a random bijection val -> (mult*val + offset) % size
+    of all possible hash values. Like a shuffled list of the universe dealt
+    round robin, each bucket receives an equal share of the values.
+    Hash values are reduced modulo the prime, so the universe is capped by it.
     """
-    all_poss_hash_vals = [x for x in range(self.highest_ID +1)]
-    buckets = [[] for _ in range(self.range)]
-    random.shuffle(all_poss_hash_vals)
-    for idx, val in enumerate(all_poss_hash_vals):
-      buckets[idx % self.range].append(val)
-    return buckets
+    size = min(self.highest_ID + 1, self.next_prime)
+    mult = int(self.rng.integers(1, size)) if size > 1 else 1
+    while math.gcd(mult, size) != 1:
+      mult = int(self.rng.integers(1, size))
+    offset = int(self.rng.integers(0, size))
+    return size, mult, offset
 
 
-  def make_buck_idx(self):
-    """Returns a dictionary mapping each value to its respective bucket."""
-    val_to_buck = {}
-    for i in range(len(self.buckets)):
-      for val in self.buckets[i]:
-        val_to_buck[val] = i
-    return val_to_buck
+  def get_bucket(self, vals):
+    """Returns the bucket of each hash value. Works on scalars and arrays."""
+    size, mult, offset = self.buck_key
+    pos = (np.asarray(vals, dtype=np.int64) * mult + offset) % size
+    return pos % self.range
 
 
   def is_chosen(self, prob, prob_sum):
@@ -78,21 +101,16 @@ class Bucket_PrivMin(pm.PrivMin):
 
 
   def get_exp_sum(self, hash_vals, delta_util):
-    """Returns the sum of ouput probabilites of each item based on the exponential mechanism."""
-    exp_sum = 0
-    min_buck = self.val_to_buck[min(hash_vals)]
-    for bucket in self.buckets:
-      util = (bucket == min_buck)
-      exp_sum += self.apply_exp_mech(util, delta_util)
-    return exp_sum
+    """Returns the sum of ouput probabilites of each bucket based on the exponential mechanism.
+    Only the bucket of the minimum has utility 1, so the sum has a closed form."""
+    return self.apply_exp_mech(1, delta_util) + (self.range - 1) * self.apply_exp_mech(0, delta_util)
 
 
   def random_bucket(self, min_buck):
-    """Returns a random bucket."""
-    buck = random.randint(0, self.range)
-    while buck == min_buck:
-      buck = random.randint(0, self.range)
-    return buck
+    """Returns a random bucket other than min_buck."""
+    prof.count('grr_redraws')
+    buck = random.randint(0, self.range - 2)
+    return buck + (buck >= min_buck)
 
   def util(self, hash_vals, val):
     """Returns the utility score of a hash value based on a binary utility function."""
@@ -107,16 +125,41 @@ class Bucket_PrivMin(pm.PrivMin):
     return math.exp( (self.eps * util) / (2 * delta_util))
 
 
+  def get_minHash_sig_matrix(self):
+    return self.get_trial_sig_matrices(1)[0]
+
+
+  def get_trial_base(self):
+    """Returns the buckets of the true minimum hash values of all users."""
+    return self.get_bucket(mh.MinHash.get_minHash_sig_matrix(self))
+
+
+  def get_trial_sig_matrices(self, trials, base=None):
+    """Randomizes the buckets of the true minimum hash values of all users
+    independently in each trial."""
+    min_bucks = self.get_trial_base() if base is None else base
+    return self.randomize_buckets(np.broadcast_to(min_bucks, (trials,) + min_bucks.shape), self.rng)
+
+
   def calc_est_Jacc(self, sig, other_sig):
     """Returns the estimated Jaccard similarity of two signatures using a
     debiased estimator."""
     collisions = 0
     for i in range(len(sig)):
             collisions += (sig[i] == other_sig[i])
-    
-    col_prob = math.exp(self.eps)/((self.range-1) + math.exp(self.eps))
+    return self.debias_collisions(collisions)
+
+
+  def debias_collisions(self, collisions):
+    """Debiased Jaccard estimate from the number of colliding buckets.
+    Works elementwise on arrays of collision counts."""
+    col_prob = self.apply_RR()
     non_col_prob = 1 - col_prob
     b = self.range
     est_Jacc = ((b* collisions) - (2* non_col_prob *self.num_hashes*(col_prob-non_col_prob)))/(self.num_hashes*b* col_prob**2)
-
     return est_Jacc
+
+
+  def calc_est_from_collisions(self, collisions):
+    """Debiases the colliding buckets counted by MinHash.count_collisions."""
+    return self.debias_collisions(collisions)
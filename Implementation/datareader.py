@@ -1,14 +1,173 @@
 import collections
 import heapq
+import os
+import numpy as np
 
 # =============================================================================
 #                 Read in user profiles
 # =============================================================================
 # Reads in user data from text files and returns a mapping from users
-# to item sets.
+# to item sets, stored as a compact CSR Dataset. The bulk readers parse whole
+# files as NumPy columns; their results are cached as .npz files.
+
+CACHE_DIR = 'input_data/cache/'
+CACHE_VERSION = 1
+LASTFM_TOP = 20
+
+
+class Dataset:
+    """CSR representation of a mapping from users to item sets. The items of
+    user u are indices[indptr[u]:indptr[u+1]], sorted and remapped to dense IDs;
+    item_ids maps a dense ID back to the original item ID. Behaves like the
+    dictionaries returned by the readers, so users can still be looked up by ID.
+    """
+
+    def __init__(self, user_ids, indptr, indices, item_ids, id_to_idx=None, item_freq=None):
+        """id_to_idx and item_freq can be passed when they are already known."""
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        if id_to_idx is None:
+            id_to_idx = {user: idx for idx, user in enumerate(self.user_ids.tolist())}
+        self.id_to_idx = id_to_idx
+        self.num_users = len(self.user_ids)
+        self.num_items = len(self.item_ids)
+        self.set_sizes = np.diff(self.indptr)
+        if item_freq is None:
+            item_freq = np.bincount(self.indices, minlength=self.num_items)
+        self.item_freq = item_freq
+        self.max_ID = int(self.item_ids[-1]) if self.num_items else 0
+        self.max_set_size = int(self.set_sizes.max()) if self.num_users else 0
+        self.avg_set_size = len(self.indices) / self.num_users if self.num_users else 0
+
+    @classmethod
+    def from_dict(cls, users):
+        """Builds the CSR arrays from a mapping of user IDs to item lists."""
+        user_ids = list(users.keys())
+        sizes = np.fromiter((len(users[user]) for user in user_ids), dtype=np.int64, count=len(user_ids))
+        rows = np.repeat(np.arange(len(user_ids)), sizes)
+        items = np.fromiter((item for user in user_ids for item in users[user]), dtype=np.int64, count=len(rows))
+        return cls.from_arrays(user_ids, rows, items)
+
+    @classmethod
+    def from_arrays(cls, user_ids, rows, items):
+        """Builds the CSR arrays from parallel arrays of row indices and original
+        item IDs, in any order and possibly with duplicates."""
+        order = np.lexsort((items, rows))
+        rows, items = rows[order], items[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (items[1:] != items[:-1])
+        rows, items = rows[keep], items[keep]
+        item_ids, indices = np.unique(items, return_inverse=True)
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=indptr[1:])
+        return cls(user_ids, indptr, indices, item_ids)
+
+    def replace_users(self, updates):
+        """Returns a new Dataset in which the users in updates (user ID -> items)
+        have the given item sets. Unknown user IDs are appended as new rows.
+        Only the changed rows are rebuilt and spliced between the unchanged
+        slices of indices; item IDs not seen before are inserted into item_ids,
+        which shifts the dense IDs of later items. Items that no user holds
+        any more stay in item_ids."""
+        users = list(updates)
+        sets = [np.unique(np.asarray(updates[user], dtype=np.int64)) for user in users]
+        new_items = np.concatenate(sets) if sets else np.zeros(0, dtype=np.int64)
+        new_items = np.unique(new_items)
+        unseen = new_items[~np.isin(new_items, self.item_ids, assume_unique=True)]
+        item_ids, indices, item_freq = self.item_ids, self.indices, self.item_freq
+        if len(unseen):
+            item_ids = np.union1d(self.item_ids, unseen)
+            old_pos = np.searchsorted(item_ids, self.item_ids).astype(np.int32)
+            indices = old_pos[indices]
+            item_freq = np.zeros(len(item_ids), dtype=self.item_freq.dtype)
+            item_freq[old_pos] = self.item_freq
+
+        id_to_idx = dict(self.id_to_idx)
+        new_users = [user for user in users if user not in id_to_idx]
+        id_to_idx.update((user, self.num_users + i) for i, user in enumerate(new_users))
+        user_ids = np.concatenate((self.user_ids, np.asarray(new_users, dtype=np.int64)))
+        rows = np.array([id_to_idx[user] for user in users], dtype=np.int64)
+        row_items = {row: np.searchsorted(item_ids, items).astype(np.int32) for row, items in zip(rows.tolist(), sets)}
+
+        item_freq = item_freq.copy()
+        for row in row_items:
+            if row < self.num_users:
+                np.subtract.at(item_freq, indices[self.indptr[row]:self.indptr[row + 1]], 1)
+            np.add.at(item_freq, row_items[row], 1)
+
+        sizes = np.concatenate((self.set_sizes, np.zeros(len(new_users), dtype=self.set_sizes.dtype)))
+        sizes[rows] = [len(items) for items in sets]
+        indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        pieces = []
+        start = 0
+        for row in sorted(row_items):
+            if row < self.num_users:
+                pieces.append(indices[self.indptr[start]:self.indptr[row]])
+                start = row + 1
+            else:
+                pieces.append(indices[self.indptr[start]:self.indptr[self.num_users]])
+                start = self.num_users
+            pieces.append(row_items[row])
+        pieces.append(indices[self.indptr[start]:self.indptr[self.num_users]])
+        return Dataset(user_ids, indptr, np.concatenate(pieces), item_ids, id_to_idx, item_freq)
+
+    def take(self, rows):
+        """Returns the users in the given rows as a Dataset of their own items."""
+        rows = np.asarray(rows, dtype=np.int64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(self.set_sizes[rows], out=indptr[1:])
+        pieces = [self.row(row) for row in rows]
+        used, indices = np.unique(np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int32),
+                                  return_inverse=True)
+        return Dataset(self.user_ids[rows], indptr, indices, self.item_ids[used])
+
+    def slice(self, start, stop):
+        """Returns the users in rows start..stop as a Dataset of their own items."""
+        indices = self.indices[self.indptr[start]:self.indptr[stop]]
+        used, indices = np.unique(indices, return_inverse=True)
+        return Dataset(self.user_ids[start:stop], self.indptr[start:stop + 1] - self.indptr[start],
+                       indices, self.item_ids[used])
+
+    def row(self, idx):
+        """Returns the dense item IDs of the user in row idx."""
+        return self.indices[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def __len__(self):
+        return self.num_users
+
+    def __iter__(self):
+        return iter(self.user_ids.tolist())
+
+    def __contains__(self, user):
+        return user in self.id_to_idx
+
+    def __getitem__(self, user):
+        """Returns the original item IDs of a user ID."""
+        return self.item_ids[self.row(self.id_to_idx[user])].tolist()
+
+    def keys(self):
+        return self.user_ids.tolist()
+
+    def values(self):
+        return (self.item_ids[self.row(idx)].tolist() for idx in range(self.num_users))
+
+    def items(self):
+        return ((user, self.item_ids[self.row(idx)].tolist()) for idx, user in enumerate(self.user_ids.tolist()))
+
+
+def as_dataset(users):
+    """Returns users as a Dataset, converting reader dictionaries."""
+    if isinstance(users, Dataset):
+        return users
+    return Dataset.from_dict(users)
 
 
 def avg_set_size(data):
+    if isinstance(data, Dataset):
+        return data.avg_set_size
     total = 0
     for pref_set in data.values():
         total += len(pref_set)
@@ -16,6 +175,8 @@ def avg_set_size(data):
 
 
 def get_max_ID(users):
+    if isinstance(users, Dataset):
+        return users.max_ID
     high = 0
     for user in users.keys():
         for item in users[user]:
@@ -117,21 +278,161 @@ def read_artificial_data(data_file):
     return users
 
 
-def read_data(data_file):
+def read_columns(data_file):
+    """Reads a whitespace separated file with a header line into a
+    (lines x columns) float64 array."""
+    with open(data_file) as f:
+        num_cols = len(f.readline().split())
+        values = np.fromstring(f.read(), sep=' ')
+    return values.reshape(-1, num_cols)
+
+
+def first_appearance(user_col):
+    """Returns the distinct users in order of first appearance and the row index
+    of each line."""
+    uniq, first, inverse = np.unique(user_col, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(uniq), dtype=np.int64)
+    rank[order] = np.arange(len(uniq))
+    return uniq[order], rank[inverse]
+
+
+def bulk_lastfm(data_file, top=LASTFM_TOP):
+    """Vectorized read_lastfm. Keeps the top heaviest artists of each user by a
+    grouped sort; users with ties at the cut-off are replayed through the heap
+    of read_lastfm so the same artists are kept."""
+    cols = read_columns(data_file).astype(np.int64)
+    user_ids, rows = first_appearance(cols[:, 0])
+    artists, weights = cols[:, 1], cols[:, 2]
+    order = np.lexsort((-weights, rows))
+    sorted_rows = rows[order]
+    starts = np.searchsorted(sorted_rows, np.arange(len(user_ids)))
+    rank = np.arange(len(order)) - starts[sorted_rows]
+    keep = order[rank < top]
+    counts = np.bincount(rows, minlength=len(user_ids))
+    long_rows = np.flatnonzero(counts > top)
+    cut = starts[long_rows] + top
+    tied = np.zeros(len(user_ids), dtype=bool)
+    tied[long_rows[weights[order[cut - 1]] == weights[order[cut]]]] = True
+    tied_rows = np.flatnonzero(tied)
+    keep = keep[~tied[rows[keep]]]
+    # lines of each user in file order, for the heap replay
+    by_row = np.argsort(rows, kind='stable')
+    extra_rows, extra_items = [], []
+    for row in tied_rows:
+        lines = by_row[starts[row]:starts[row] + counts[row]]
+        min_heap = []
+        for weight, artist in zip(weights[lines].tolist(), artists[lines].tolist()):
+            if len(min_heap) < top:
+                heapq.heappush(min_heap, (weight, artist))
+            elif weight > min_heap[0][0]:
+                heapq.heapreplace(min_heap, (weight, artist))
+        extra_rows += [row] * len(min_heap)
+        extra_items += [artist for _, artist in min_heap]
+    rows = np.concatenate((rows[keep], np.array(extra_rows, dtype=np.int64)))
+    items = np.concatenate((artists[keep], np.array(extra_items, dtype=np.int64)))
+    return Dataset.from_arrays(user_ids, rows, items)
+
+
+def bulk_movielens(data_file):
+    """Vectorized read_movielens."""
+    cols = read_columns(data_file)
+    user_ids, rows = first_appearance(cols[:, 0].astype(np.int64))
+    liked = cols[:, 2] >= 4
+    present = np.zeros(len(user_ids), dtype=bool)
+    present[rows[liked]] = True
+    new_row = np.cumsum(present) - 1
+    return Dataset.from_arrays(user_ids[present], new_row[rows[liked]], cols[liked, 1].astype(np.int64))
+
+
+def bulk_artificial_data(data_file):
+    """Vectorized read_artificial_data."""
+    with open(data_file) as f:
+        f.readline()
+        lines = f.read().splitlines()
+    sizes = np.array([line.count(',') + 1 for line in lines], dtype=np.int64)
+    items = np.fromstring(' '.join(lines).replace(',', ' '), sep=' ').astype(np.int64)
+    rows = np.repeat(np.arange(len(lines)), sizes)
+    return Dataset.from_arrays(np.arange(1, len(lines) + 1), rows, items)
+
+
+def cache_path(data_file):
+    """Returns the path of the binary cache of a dataset file name."""
+    return os.path.join(CACHE_DIR, data_file + '.npz')
+
+
+def load_cached(data_file):
+    """Returns the cached Dataset of a dataset file name, or None if there is no
+    cache or the source file changed since it was written."""
+    cache_file = cache_path(data_file)
+    if not os.path.exists(cache_file):
+        return None
+    fingerprint = file_fingerprint(data_path(data_file))
+    with np.load(cache_file) as cached:
+        if (int(cached['version']) != CACHE_VERSION or int(cached['size']) != fingerprint['size']
+                or int(cached['mtime_ns']) != fingerprint['mtime_ns']):
+            return None
+    return load_dataset(cache_file)
+
+
+def save_cached(data_file, data):
+    """Writes a Dataset to the binary cache of a dataset file name."""
+    cache_file = cache_path(data_file)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    save_dataset(cache_file, data, version=CACHE_VERSION, **file_fingerprint(data_path(data_file)))
+
+
+def save_dataset(filename, data, **meta):
+    """Writes a Dataset and optional scalar metadata to a binary .npz file."""
+    tmp_file = filename + '.tmp.npz'
+    np.savez(tmp_file, user_ids=data.user_ids, indptr=data.indptr, indices=data.indices,
+             item_ids=data.item_ids, **meta)
+    os.replace(tmp_file, filename)
+
+
+def load_dataset(filename):
+    """Reads a Dataset written by save_dataset."""
+    with np.load(filename) as stored:
+        return Dataset(stored['user_ids'], stored['indptr'], stored['indices'], stored['item_ids'])
+
+
+def data_path(data_file):
+    """Returns the path of a dataset file name."""
+    return 'input_data/' + data_file
+
+
+def file_fingerprint(path):
+    """Returns size and modification time of a file, used to tell whether
+    anything derived from it is out of date."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_data(data_file, cache=True):
     """Main method of class. Receives a text file as string and chooses which
-    function to call to process the data set. Returns a dictionary mapping user IDs
-    to item sets.
+    function to call to process the data set. Returns a Dataset mapping user IDs
+    to item sets. The Dataset is cached in binary form and reused as long as
+    size and modification time of the text file are unchanged. Datasets in
+    the binary format (.npz) are read directly.
     """
-    data_file = 'input_data/' + data_file
-    if 'movielens' in data_file:
-        users = read_movielens(data_file)
-    elif 'lastfm' in data_file:
-        users = read_lastfm(data_file)
-    elif 'artificial' in data_file.lower():
-        users = read_artificial_data(data_file)
+    path = data_path(data_file)
+    if path.endswith('.npz'):
+        return load_dataset(path)
+    if cache:
+        data = load_cached(data_file)
+        if data is not None:
+            return data
+    if 'movielens' in path:
+        data = bulk_movielens(path)
+    elif 'lastfm' in path:
+        data = bulk_lastfm(path)
+    elif 'artificial' in path.lower():
+        data = bulk_artificial_data(path)
     else:
-        print("ERROR: DataReader couldn't determine dataset")
-    return users
+        raise ValueError("DataReader couldn't determine dataset of " + data_file)
+    if cache:
+        save_cached(data_file, data)
+    return data
 
 
 
@@ -0,0 +1,116 @@
+import time
+import numpy as np
+import analysis as anal
+import simjoin as sj
+
+# =============================================================================
+#                 LSH Banding Index
+# =============================================================================
+# Splits (n_users x k) signatures of MinHash, PrivMin or Bucket PrivMin into
+# b bands of r rows and hashes every band into buckets. Users sharing a bucket
+# in any band become candidate pairs, which are re-ranked with the estimator
+# of the algorithm. Only candidates are compared instead of all pairs.
+
+
+class LSHIndex:
+    def __init__(self, MH_algo, user_to_sig, bands, rows, max_bucket_size=None, seed=0):
+        """max_bucket_size optionally skips buckets holding more users, which
+        would otherwise add a quadratic number of candidates."""
+        self.MH_algo = MH_algo
+        self.sigs = user_to_sig.matrix
+        self.size = len(self.sigs)
+        self.bands = bands
+        self.rows = rows
+        self.max_bucket_size = max_bucket_size
+        if bands * rows > self.sigs.shape[1]:
+            raise ValueError('bands * rows exceeds the signature length')
+        rng = np.random.default_rng(seed)
+        self.mults = rng.integers(1, 2**63, size=rows, dtype=np.uint64) | np.uint64(1)
+        self.cand_indptr, self.cands = self.candidate_lists(self.candidate_pairs())
+        self.num_candidates = len(self.cands) // 2
+
+
+    def band_keys(self, band):
+        """Hashes the rows of a band of all signatures to one uint64 key each."""
+        values = self.sigs[:, band * self.rows:(band + 1) * self.rows].astype(np.uint64)
+        keys = np.full(self.size, band, dtype=np.uint64)
+        for r in range(self.rows):
+            keys = keys * np.uint64(31) + values[:, r] * self.mults[r]
+        return keys
+
+
+    def candidate_pairs(self):
+        """Returns all pairs (i, j), i < j, sharing a bucket in some band,
+        encoded as i * n + j."""
+        pairs = []
+        for band in range(self.bands):
+            keys = self.band_keys(band)
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+            group_sizes = np.diff(np.append(starts, self.size))
+            group_of = np.repeat(np.arange(len(starts)), group_sizes)
+            largest = int(group_sizes.max())
+            if self.max_bucket_size is not None:
+                allowed = group_sizes[group_of] <= self.max_bucket_size
+                # pairs of skipped buckets lie further apart than any allowed bucket
+                largest = int(group_sizes[group_sizes <= self.max_bucket_size].max(initial=0))
+            else:
+                allowed = np.ones(self.size, dtype=bool)
+            for dist in range(1, largest):
+                same = (group_of[dist:] == group_of[:-dist]) & allowed[dist:]
+                first, second = order[:-dist][same], order[dist:][same]
+                pairs.append(np.minimum(first, second).astype(np.int64) * self.size + np.maximum(first, second))
+        if not pairs:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(pairs))
+
+
+    def candidate_lists(self, pairs):
+        """Turns encoded pairs into CSR lists of the candidates of every user."""
+        first, second = pairs // self.size, pairs % self.size
+        users = np.concatenate((first, second))
+        cands = np.concatenate((second, first))
+        order = np.lexsort((cands, users))
+        indptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(users, minlength=self.size), out=indptr[1:])
+        return indptr, cands[order]
+
+
+    def query(self, M=100):
+        """Returns the top M candidates of every user, ranked by the estimated
+        Jaccard similarity of the algorithm, as Neighbours."""
+        indices = np.full((self.size, M), -1, dtype=np.int32)
+        scores = np.zeros((self.size, M), dtype=np.float32)
+        for user in range(self.size):
+            cands = self.cands[self.cand_indptr[user]:self.cand_indptr[user + 1]]
+            if len(cands) == 0:
+                continue
+            sims = self.MH_algo.calc_est_Jacc_block(self.sigs[user:user + 1], self.sigs[cands])[0]
+            order = np.lexsort((cands, -sims))[:M]
+            indices[user, :len(order)] = cands[order]
+            scores[user, :len(order)] = sims[order]
+        return sj.Neighbours(indices, scores)
+
+
+def compare_with_exhaustive(MH_algo, user_to_sig, JSim, configs, M=100):
+    """Measures time, number of candidate pairs and PRF of LSH indices with the
+    given (bands, rows) configs against the exhaustive scan over all pairs."""
+    results = []
+    start = time.perf_counter()
+    estJSim = anal.set_estJSim(MH_algo, user_to_sig)
+    analysis = anal.Analysis(user_to_sig, JSim, estJSim)
+    analysis.M = M
+    prec, recall, f1 = analysis.PRF()
+    n = len(user_to_sig)
+    results.append({'bands': None, 'rows': None, 'candidates': n * (n - 1) // 2,
+                    'seconds': time.perf_counter() - start, 'precision': prec, 'recall': recall, 'f1': f1})
+    for bands, rows in configs:
+        start = time.perf_counter()
+        index = LSHIndex(MH_algo, user_to_sig, bands, rows)
+        analysis = anal.Analysis(user_to_sig, JSim, index.query(M))
+        analysis.M = M
+        prec, recall, f1 = analysis.PRF()
+        results.append({'bands': bands, 'rows': rows, 'candidates': index.num_candidates,
+                        'seconds': time.perf_counter() - start, 'precision': prec, 'recall': recall, 'f1': f1})
+    return results
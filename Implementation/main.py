@@ -10,54 +10,56 @@ import privmin
 import bucket_privmin
 import sec_minhash
 import noisy_sec_minhash
+import simjoin
 
 
 
 
-def setup(file):
+def setup(file, top_N=None):
     
     data = dr.read_data(file) 
     data_size = len(data.keys()) 
-    
-    filename_JSim = 'JSims/'+ file.replace('.dat', '_truth.txt')
-    
-    # comment in when using an unknown data set
-    # preprocessing.set_initial_JSim(data, data_size, filename_JSim)
-    
-    JSim = preprocessing.set_JSim(data_size, filename_JSim)
-        
-    return data, JSim
 
+    # only the exact top N neighbours, for large sparse data sets whose full truth
+    # is too large; on small or dense data sets calc_JSim is faster (benchmark.py simjoin)
+    if top_N is not None:
+        return data, simjoin.top_N_neighbours(data, top_N)
+
+    filename_JSim = 'JSims/'+ os.path.splitext(file)[0] + '_truth.bin'
+    fingerprint = dr.file_fingerprint(dr.data_path(file))
 
+    # the truth is recomputed whenever the data file or its users have changed
+    if not preprocessing.is_current(filename_JSim, fingerprint, data.keys()):
+        preprocessing.set_initial_JSim(data, data_size, filename_JSim, fingerprint)
 
-def hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets):
+    JSim = preprocessing.set_JSim(data_size, filename_JSim)
+    
+    return data, JSim
+
+ 
+def make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed=None, base_cache=None):
     next_prime = 2**31 -1
 
     if 'privmin' == minhash_type.lower():
-        priv = privmin.PrivMin(num_hashes, data, eps)
-        user_to_sig = priv.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(priv, user_to_sig)
+        return privmin.PrivMin(num_hashes, data, eps, seed=seed, base_cache=base_cache)
 
     elif 'bucket' in minhash_type.lower():
-        bucket_priv = bucket_privmin.Bucket_PrivMin(num_hashes, data, eps, num_buckets, False)
-        user_to_sig = bucket_priv.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(bucket_priv, user_to_sig)
+        return bucket_privmin.Bucket_PrivMin(num_hashes, data, eps, num_buckets, False, seed=seed, base_cache=base_cache)
         
     elif 'sec_minhash' == minhash_type.lower():
-        sec_mh = sec_minhash.Sec_MinHash(num_hashes, data, l)
-        user_to_sig = sec_mh.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(sec_mh, user_to_sig)
+        return sec_minhash.Sec_MinHash(num_hashes, data, l, seed=seed)
 
     elif 'noisy' in minhash_type.lower():
-        noisy_sec = noisy_sec_minhash.Noisy_Sec_MinHash(num_hashes, data, eps, l, alpha, delta, b=b)
-        user_to_sig = noisy_sec.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(noisy_sec, user_to_sig)
+        return noisy_sec_minhash.Noisy_Sec_MinHash(num_hashes, data, eps, l, alpha, delta, b=b, seed=seed)
 
     else:
-        reg_mh = minhash.MinHash(num_hashes, data)
-        user_to_sig = reg_mh.generate_minHash_sigs()
-        estJSim = anal.set_estJSim(reg_mh, user_to_sig)
+        return minhash.MinHash(num_hashes, data, seed=seed, base_cache=base_cache)
 
+
+def hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, workers=None, seed=None, base_cache=None):
+    MH_algo = make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed, base_cache)
+    user_to_sig = MH_algo.generate_minHash_sigs(workers)
+    estJSim = anal.set_estJSim(MH_algo, user_to_sig)
     return user_to_sig, estJSim
 
 
@@ -74,12 +76,19 @@ def run_analysis(user_to_sig, JSim, estJSim, neighbours):
 
 
 
-def main(data, JSim, minhash_type, num_hashes, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None):
+def main(data, JSim, minhash_type, num_hashes, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None, workers=None, seed=None, base_cache=None):
 
-    user_to_sig, est_JSim = hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets)
+    user_to_sig, est_JSim = hashing(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, workers, seed, base_cache)
 
     analysis = anal.Analysis(user_to_sig, JSim, est_JSim)
     
     return analysis
 
 
+def trials(data, JSim, minhash_type, num_hashes, num_trials, eps=None, delta = None, l=None, b=None, alpha=None, num_buckets = None, seed=None, confidence=0.95):
+    """Returns mean, standard deviation and confidence interval of each measure
+    over num_trials randomizations sharing the same hash functions."""
+    MH_algo = make_algorithm(data, num_hashes, eps, minhash_type, l, b, alpha, delta, num_buckets, seed)
+    return anal.run_trials(MH_algo, JSim, num_trials, confidence)
+
+
@@ -1,6 +1,12 @@
-import random
-import collections
+import copy
+import concurrent.futures
+import numpy as np
+import scipy.sparse
+import basehash as bh
 import datareader as dr
+import profiling as prof
+import signatures as sg
+import simmatrix as sm
 
 
 
@@ -8,17 +14,33 @@ import datareader as dr
 #                 Generate MinHash Signatures
 # =============================================================================
 # Generates MinHash signatures of length (num_hashes) for all users.
+# Each distinct item is hashed once with all hash functions, the minima are
+# then taken per user over the flat item array.
+# Users are split into shards of fixed size, processed in this process or by a
+# pool of worker processes; each shard draws from its own random stream
+# derived from the seed, so results do not depend on the number of workers.
+
+MAX_BLOCK_CELLS = 2**22  # bounds the hash values gathered at once
+TILE_SIZE = 256  # users per side of a tile of estimated similarities
+SHARD_SIZE = 2048  # users per shard in parallel signature generation
 
 class MinHash:
-  def __init__(self, num_hashes, users):
+  exact_mins = True  # signatures are the true minima, so added items only lower them
+  sparse_collisions = True  # estimates depend only on the numbers of equal positions
+
+  def __init__(self, num_hashes, users, seed=None, base_cache=None):
     self.num_hashes = num_hashes
-    self.users = users 
-    self.data_size = len(users)
-    self.highest_ID = dr.get_max_ID(users)
+    self.seed = seed
+    self.base_cache = base_cache
+    self.rng = np.random.default_rng(seed)
+    self.users = dr.as_dataset(users)
+    self.data_size = self.users.num_users
+    self.highest_ID = self.users.max_ID
     self.next_prime = 2**31 -1
     self.id_to_idx = {}   
     self.coeffA = None
     self.coeffB = None
+    self.user_to_sig = None
 
 
 
@@ -26,13 +48,18 @@ class MinHash:
     """Generates unique random coefficients for the hash functions."""
     rand_list = []
     for i in range(self.num_hashes):  
-      rand_idx = random.randint(0, self.next_prime) 
+      rand_idx = self.rand_int() 
       while rand_idx in rand_list:
-        rand_idx = random.randint(0, self.next_prime)     
+        rand_idx = self.rand_int()     
       rand_list.append(rand_idx)
     return rand_list
 
 
+  def rand_int(self):
+    """Draws a random integer in [0, next_prime] from the seeded generator."""
+    return int(self.rng.integers(0, self.next_prime, endpoint=True))
+
+
   def setup(self):
     self.coeffA = self.pick_random_coeffs()
     self.coeffB = self.pick_random_coeffs() 
@@ -43,6 +70,7 @@ class MinHash:
 
 
   def hash_item(self, item, k):
+    prof.count('hash_evals')
     return ((self.coeffA[k] * item + self.coeffB[k]) % self.next_prime) % self.highest_ID
 
 
@@ -56,16 +84,199 @@ class MinHash:
     return signature
 
 
-  def generate_minHash_sigs(self):
-    """Generates MinHash signatures for all users."""
+  def hash_items(self, items, coeffA, coeffB):
+    """Vectorized hash_item. Hashes an array of items with all given coefficients
+    and returns a (len(items) x len(coeffA)) array. Uses uint64 arithmetic with
+    Mersenne prime reduction, which gives the same values as hash_item."""
+    a = np.asarray(coeffA, dtype=np.uint64) % np.uint64(self.next_prime)
+    b = np.asarray(coeffB, dtype=np.uint64) % np.uint64(self.next_prime)
+    x = np.asarray(items, dtype=np.uint64) % np.uint64(self.next_prime)
+    prof.count('hash_evals', len(x) * len(a))
+    vals = mersenne_mod(x[:, None] * a[None, :] + b[None, :], self.next_prime)
+    return (vals % np.uint64(self.highest_ID)).astype(np.int64)
+
+
+  def get_minHash_sig_matrix(self):
+    """Returns the (n_users x num_hashes) matrix of minimum hash values."""
+    return self.get_base_hashes(np.ones(self.data_size, dtype=np.int64)).mins
+
+
+  def get_trial_base(self):
+    """Returns the part of the signatures shared by all trials."""
+    return self.get_minHash_sig_matrix()
+
+
+  def get_trial_sig_matrices(self, trials, base=None):
+    """Returns (trials x n_users x signature length) signature matrices of
+    independent trials for the drawn hash functions, from base of
+    get_trial_base if given. Without randomization all trials are equal."""
+    matrix = self.get_trial_base() if base is None else base
+    return np.broadcast_to(matrix, (trials,) + matrix.shape)
+
+
+  def generate_trial_sigs(self, trials):
+    """Draws the hash functions once and returns the signature matrices of
+    trials independent randomizations, see get_trial_sig_matrices."""
+    self.setup()
+    return self.get_trial_sig_matrices(trials)
+
+
+  def iter_trial_sigs(self, trials, batch):
+    """Like generate_trial_sigs, but yields the signature matrices in batches
+    of at most batch trials, so only one batch is held in memory. The part
+    shared by all trials is computed once."""
     self.setup()
-    user_to_sig = collections.OrderedDict()
-    for userID in self.users.keys():
-      signature = self.get_minHash_sig(userID)
-      user_to_sig[userID] = signature
+    base = self.get_trial_base()
+    for start in range(0, trials, batch):
+      yield self.get_trial_sig_matrices(min(batch, trials - start), base)
+
+
+  def get_base_hashes(self, lengths):
+    """Returns the lengths[u] smallest hash values of each user u as BaseHashes,
+    from base_cache if one is set."""
+    if self.base_cache is None:
+      return self.compute_base_hashes(lengths)
+    key = bh.base_hash_key(self.users, self.coeffA, self.coeffB, self.highest_ID, self.next_prime)
+    return self.base_cache.get(key, lengths, self.compute_base_hashes)
+
+
+  def compute_base_hashes(self, lengths):
+    hashes = self.hash_items(self.users.item_ids, self.coeffA, self.coeffB)
+    if np.all(lengths == 1):
+      return bh.BaseHashes(lengths, segment_min(hashes, self.users.indices, self.users.indptr))
+    return bh.compute_base_hashes(hashes, self.users, lengths)
+
+
+  def generate_minHash_sigs(self, workers=None):
+    """Generates MinHash signatures for all users in shards, see
+    get_sharded_sig_matrix. If workers is given, the shards are processed by
+    that many worker processes, otherwise in this process; the signatures for
+    a seed are the same either way."""
+    self.setup()
+    matrix = self.get_sharded_sig_matrix(workers or 1)
+    user_to_sig = self.make_signatures(matrix)
+    self.id_to_idx = user_to_sig.id_to_idx
+    self.user_to_sig = user_to_sig
     return user_to_sig
 
 
+  def make_shard(self, start, stop, seed_seq):
+    """Returns a copy of the algorithm restricted to the users start..stop, with
+    the hash functions of setup and its own random generator."""
+    return self.make_part(self.users.slice(start, stop), np.random.default_rng(seed_seq))
+
+
+  def make_part(self, users, rng):
+    """Returns a copy of the algorithm for a Dataset of some of its users, with
+    the hash functions of setup and the given random generator."""
+    part = copy.copy(self)
+    part.users = users
+    part.data_size = users.num_users
+    part.rng = rng
+    part.id_to_idx = {}
+    part.user_to_sig = None
+    part.base_cache = None
+    return part
+
+
+  def get_sharded_sig_matrix(self, workers, shard_size=SHARD_SIZE):
+    """Computes the signature matrix in shards of shard_size users. Shard i draws
+    from the stream SeedSequence(entropy, spawn_key=(i,)), with entropy taken
+    from the seeded generator, so results for a seed are the same for any
+    number of workers. Hot-path counts of the workers are merged."""
+    entropy = int(self.rng.integers(2**63))
+    shards = [self.make_shard(start, min(start + shard_size, self.data_size),
+                              np.random.SeedSequence(entropy, spawn_key=(i,)))
+              for i, start in enumerate(range(0, self.data_size, shard_size))]
+    if workers <= 1 or len(shards) <= 1:
+      for shard in shards:
+        shard.base_cache = self.base_cache
+      parts = [shard_sig_matrix(shard) for shard in shards]
+    else:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(prof.counted, [shard_sig_matrix] * len(shards), shards))
+      parts = [part for part, _ in results]
+      for _, counts in results:
+        prof.merge(counts)
+    return np.concatenate(parts)
+
+
+  def make_signatures(self, matrix):
+    """Wraps a signature matrix with the user IDs."""
+    return sg.Signatures(self.users.keys(), matrix)
+
+
+  def add_items(self, user_id, items, estJSim=None):
+    """Adds items to the set of a user, or a new user, see update_users."""
+    return self.update_users(added={user_id: items}, estJSim=estJSim)
+
+
+  def remove_items(self, user_id, items, estJSim=None):
+    """Removes items from the set of a user, see update_users."""
+    return self.update_users(removed={user_id: items}, estJSim=estJSim)
+
+
+  def update_users(self, added=None, removed=None, estJSim=None):
+    """Applies added and removed items (user ID -> items) to the signatures from
+    generate_minHash_sigs, keeping the hash functions. Signatures of users that
+    only gained items are lowered elementwise by the hashes of the new items,
+    other changed users are recomputed from their item sets. If estJSim is
+    given, the rows and columns of the changed users are re-estimated.
+    Returns the signatures and estJSim, which is resized when users are new.
+    Randomized algorithms redraw the signatures of all changed users."""
+    added = added or {}
+    removed = removed or {}
+    updates = {}
+    for user in dict.fromkeys(list(added) + list(removed)):
+      items = set(self.users[user]) if user in self.users else set()
+      updates[user] = sorted((items | set(added.get(user, ()))) - set(removed.get(user, ())))
+    self.users = self.users.replace_users(updates)
+    self.data_size = self.users.num_users
+
+    sigs = self.user_to_sig.matrix
+    num_new = self.data_size - len(sigs)
+    if num_new:
+      sigs = np.vstack((sigs, np.zeros((num_new, sigs.shape[1]), dtype=sigs.dtype)))
+    rows = [self.users.id_to_idx[user] for user in updates]
+    recompute = []
+    for user, row in zip(updates, rows):
+      if not self.exact_mins or user in removed or row >= len(self.user_to_sig):
+        recompute.append(row)
+      else:
+        hashes = self.hash_items(added[user], self.coeffA, self.coeffB)
+        np.minimum(sigs[row], hashes.min(axis=0), out=sigs[row])
+    if recompute:
+      sigs[recompute] = self.get_minHash_sig_rows(recompute)
+    if num_new:
+      self.user_to_sig = self.make_signatures(sigs)
+      self.id_to_idx = self.user_to_sig.id_to_idx
+
+    if estJSim is not None:
+      estJSim = self.update_est_Jacc_rows(estJSim, rows)
+    return self.user_to_sig, estJSim
+
+
+  def get_minHash_sig_rows(self, rows):
+    """Returns the signatures of the users in the given rows."""
+    return self.make_part(self.users.take(rows), self.rng).get_minHash_sig_matrix()
+
+
+  def update_est_Jacc_rows(self, estJSim, rows, tile_size=TILE_SIZE):
+    """Re-estimates the rows and columns of the given users in a SimMatrix."""
+    sigs = self.user_to_sig.matrix
+    if estJSim.size != len(sigs):
+      estJSim = estJSim.resized(len(sigs))
+    for start in range(0, len(rows), tile_size):
+      block_rows = rows[start:start + tile_size]
+      tiles = [self.calc_est_Jacc_block(sigs[block_rows], sigs[col:col + tile_size])
+               for col in range(0, len(sigs), tile_size)]
+      block = np.hstack(tiles)
+      for row, sims in zip(block_rows, block):
+        sims[row] = 0
+        estJSim.set_row(row, sims)
+    return estJSim
+
+
   def calc_est_Jacc(self, sig, other_sig):
     """Receives two signatures and calculates their estimated Jaccard similarity."""
     intersection = 0
@@ -79,11 +290,85 @@ class MinHash:
         return intersection/ union
 
 
- 
+  def count_collisions(self, sigs, other_sigs):
+    """Returns the int32 matrix of equal positions between the rows of two
+    signature matrices. Counts are accumulated in uint8 while they fit."""
+    collisions = np.zeros((len(sigs), len(other_sigs)), dtype=np.uint8 if sigs.shape[1] < 256 else np.int32)
+    columns, other_columns = np.ascontiguousarray(sigs.T), np.ascontiguousarray(other_sigs.T)
+    for k in range(sigs.shape[1]):
+      collisions += columns[k][:, None] == other_columns[k][None, :]
+    return collisions.astype(np.int32, copy=False)
+
+
+  def calc_est_Jacc_block(self, sigs, other_sigs):
+    """Returns the estimated Jaccard similarities between all rows of two
+    signature matrices."""
+    if sigs.shape[1] == 0:
+      return np.zeros((len(sigs), len(other_sigs)))
+    return self.calc_est_from_collisions(self.count_collisions(sigs, other_sigs))
+
+
+  def calc_est_from_collisions(self, collisions):
+    """Returns the estimated Jaccard similarities from the numbers of equal
+    signature positions."""
+    return collisions / self.num_hashes
+
+
+  def collision_matrix(self, sigs):
+    """Returns a sparse 0/1 matrix with a row per user and a column per distinct
+    (position, value) of the signatures. Its product with its transpose counts
+    the equal positions of all pairs of users, without comparing pairs that
+    share no value."""
+    num_users, length = sigs.shape
+    sigs = sigs.astype(np.int64)
+    keys = np.arange(length, dtype=np.int64) * (int(sigs.max()) + 1) + sigs
+    _, columns = np.unique(keys.ravel(), return_inverse=True)
+    indptr = np.arange(0, num_users * length + 1, length)
+    return scipy.sparse.csr_matrix((np.ones(num_users * length, dtype=np.int32), columns.ravel(), indptr),
+                                   shape=(num_users, int(columns.max()) + 1))
+
+
+  def calc_est_Jacc_matrix(self, user_to_sig, tile_size=TILE_SIZE, dtype=np.float32):
+    """Returns the SimMatrix of estimated Jaccard similarities of all pairs of
+    users and the mapping from user IDs to its rows. The upper triangle is
+    computed in tiles of tile_size x tile_size users to bound peak memory."""
+    sigs = user_to_sig.matrix
+    estJSim = sm.SimMatrix(len(sigs), dtype=dtype)
+    for start in range(0, len(sigs), tile_size):
+      rows = sigs[start:start + tile_size]
+      tiles = [self.calc_est_Jacc_block(rows, sigs[other_start:other_start + tile_size])
+               for other_start in range(start, len(sigs), tile_size)]
+      estJSim.set_rows(start, np.hstack(tiles))
+    return estJSim, dict(user_to_sig.id_to_idx)
+
 
+def shard_sig_matrix(shard):
+  """Returns the signature matrix of a shard made by make_shard."""
+  return shard.get_minHash_sig_matrix()
 
-    
-  
 
+def mersenne_mod(vals, prime):
+  """Reduces uint64 values below 2**63 modulo the Mersenne prime 2**31 - 1."""
+  shift = np.uint64(31)
+  p = np.uint64(prime)
+  vals = (vals & p) + (vals >> shift)
+  vals = (vals & p) + (vals >> shift)
+  return np.where(vals >= p, vals - p, vals)
 
 
+def segment_min(hashes, indices, indptr):
+  """Returns the minimum of hashes[indices[indptr[u]:indptr[u+1]]] for each user u,
+  gathering blocks of users at a time."""
+  if np.any(np.diff(indptr) == 0):
+    raise ValueError('MinHash signatures need non-empty item sets')
+  num_users = len(indptr) - 1
+  sigs = np.empty((num_users, hashes.shape[1]), dtype=hashes.dtype)
+  max_rows = max(1, MAX_BLOCK_CELLS // max(1, hashes.shape[1]))
+  start = 0
+  while start < num_users:
+    stop = max(start + 1, int(np.searchsorted(indptr, indptr[start] + max_rows, side='right')) - 1)
+    stop = min(stop, num_users)
+    rows = hashes[indices[indptr[start]:indptr[stop]]]
+    sigs[start:stop] = np.minimum.reduceat(rows, indptr[start:stop] - indptr[start], axis=0)
+    start = stop
+  return sigs
@@ -3,12 +3,16 @@ import math
 import numpy as np
 import minhash as mh
 import sec_minhash as sec_mh
+import signatures as sg
 
 # =============================================================================
 #                 Generate signatures by Noisy Secure MinHash
 # =============================================================================
 # Concatenates k minimum hash values, maps them to 1 bit and adds noise to them.
-# Returns noisy signature of length L.
+# Returns noisy signature of length L. Signatures are stored as a float32 matrix
+# and the noise for a block of users is drawn in one call.
+
+NOISE_BLOCK_CELLS = 2**22  # bounds the noise drawn at once
 
 
 class Noisy_Sec_MinHash(sec_mh.Sec_MinHash):
@@ -18,8 +22,8 @@ class Noisy_Sec_MinHash(sec_mh.Sec_MinHash):
   B is an optional argument to directly set noise scale.
   """ 
 
-  def __init__(self, num_hashes, users, eps, L, alpha, delta, b=None):
-      sec_mh.Sec_MinHash.__init__(self, num_hashes, users, L)
+  def __init__(self, num_hashes, users, eps, L, alpha, delta, b=None, seed=None):
+      sec_mh.Sec_MinHash.__init__(self, num_hashes, users, L, seed)
       self.T = 20
       self.delta = delta
       self.alpha = alpha
@@ -45,8 +49,8 @@ class Noisy_Sec_MinHash(sec_mh.Sec_MinHash):
     sensi = exp_diff*(1 + beta)
     return sensi
 
-  def draw_noise(self):
-    a = np.random.laplace(scale=self.sensitivity/ self.eps, size=1)
+  def draw_noise(self, size=1):
+    a = self.rng.laplace(scale=self.sensitivity/ self.eps, size=size)
     return a
 
   def hash_universal(self, signature, k, l):
@@ -57,11 +61,60 @@ class Noisy_Sec_MinHash(sec_mh.Sec_MinHash):
     return (uni % self.next_prime % 2) + self.draw_noise()
 
 
+  def get_minHash_sig_matrix(self):
+    """Returns the (n_users x L) float32 matrix of noisy signature bits."""
+    return self.get_trial_sig_matrices(1)[0]
+
+
+  def get_trial_base(self):
+    """Returns the (n_users x L) float32 matrix of signature bits."""
+    bits = np.empty((self.data_size, self.L), dtype=np.float32)
+    for rows, ls, block_bits in self.iter_bit_blocks():
+      bits[rows, ls] = block_bits
+    return bits
+
+
+  def get_trial_sig_matrices(self, trials, base=None):
+    """Returns (trials x n_users x L) noisy signature bits. The bits are
+    computed once and fresh noise is added in every trial."""
+    bits = self.get_trial_base() if base is None else base
+    sigs = np.empty((trials, self.data_size, self.L), dtype=np.float32)
+    block = max(1, NOISE_BLOCK_CELLS // max(1, trials * self.L))
+    for start in range(0, self.data_size, block):
+      rows = sigs[:, start:start + block]
+      rows[:] = bits[start:start + block]
+      rows += self.draw_noise(rows.shape).astype(np.float32)
+    return sigs
+
+
+  def make_signatures(self, matrix):
+    return sg.Signatures(self.users.keys(), matrix)
+
+
   def calc_est_Jacc(self, signature, other_signature):
     """Debiased Jaccard similarity estimator"""
-    sig = np.array(signature)
-    oth = np.array(other_signature)
+    sig = np.array(signature, dtype=np.float64)
+    oth = np.array(other_signature, dtype=np.float64)
     euc_dist = np.square(sig - oth).sum()
-    euc_dist -= (self.L * 2 * self.var_lap)
+    return self.debias_distances(euc_dist)
+
+
+  def debias_distances(self, euc_dist):
+    """Debiased Jaccard estimate from squared Euclidean distances.
+    Works elementwise on arrays."""
+    euc_dist = euc_dist - (self.L * 2 * self.var_lap)
     collisions = self.L - euc_dist
     return 2*(collisions/self.L) - 1
+
+
+  def squared_distances(self, sigs, other_sigs):
+    """Returns all squared Euclidean distances between the rows of two signature
+    matrices as |a|^2 + |b|^2 - 2ab, with the products computed by BLAS."""
+    norms = np.square(sigs, dtype=np.float64).sum(axis=1)
+    other_norms = np.square(other_sigs, dtype=np.float64).sum(axis=1)
+    gram = (sigs @ other_sigs.T).astype(np.float64)
+    return np.maximum(norms[:, None] + other_norms[None, :] - 2 * gram, 0)
+
+
+  def calc_est_Jacc_block(self, sigs, other_sigs):
+    return self.debias_distances(self.squared_distances(sigs, other_sigs))
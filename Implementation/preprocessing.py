@@ -1,7 +1,25 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import numpy as np
+import scipy.sparse
+import datareader as dr
+import simmatrix as sm
+
 # =============================================================================
 #                  Preprocessing
 # =============================================================================
 # Script used to generate the true Jaccard similarity values of the data.
+# Intersections of all pairs are computed as the sparse product A * A^T of the
+# user x item matrix in blocks of rows, unions follow from the set sizes.
+# The truth is stored in a binary file: a JSON header with the user IDs, the
+# dtype and the fingerprint of the data file, followed by the raw condensed
+# matrix, which is opened as a memory map.
+
+TRUTH_BLOCK_SIZE = 512  # users per block of rows of the sparse product
+TRUTH_MAGIC = b'JSIMBIN1'
+TRUTH_ALIGN = 64
 
 
 def calc_Jacc(pref_set, other_pref_set):
@@ -15,60 +33,153 @@ def calc_Jacc(pref_set, other_pref_set):
             return intersection/ union
 
 
-def set_initial_JSim(data, data_size, filename_truth):
-    """Fills in the JSim Matrix and writes it to a file"""
+_truth_users = None
+
+
+def init_truth_worker(indptr, indices, num_items):
+    """Builds the sparse user x item matrix once per worker process."""
+    global _truth_users
+    data = np.ones(len(indices), dtype=np.float32)
+    _truth_users = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, num_items))
+
+
+def calc_JSim_block(bounds):
+    """Returns the Jaccard similarities of users start..stop with all users from
+    start onwards, as dense rows."""
+    start, stop = bounds
+    users = _truth_users
+    sizes = np.diff(users.indptr)
+    intersection = (users[start:stop] @ users[start:].T).toarray()
+    union = sizes[start:stop, None] + sizes[None, start:] - intersection
+    JSims = np.divide(intersection, union, out=np.zeros(intersection.shape), where=union > 0)
+    return start, JSims.astype(np.float32)
+
+
+def calc_JSim(data, block_size=TRUTH_BLOCK_SIZE, workers=None):
+    """Returns the SimMatrix of true Jaccard similarities of all pairs of users.
+    Blocks of rows are computed in parallel by a pool of worker processes."""
+    data = dr.as_dataset(data)
+    JSim = sm.SimMatrix(data.num_users)
+    bounds = [(start, min(start + block_size, data.num_users)) for start in range(0, data.num_users, block_size)]
+    init_args = (data.indptr, data.indices, data.num_items)
+    if workers == 1 or len(bounds) <= 1:
+        init_truth_worker(*init_args)
+        for start, rows in map(calc_JSim_block, bounds):
+            JSim.set_rows(start, rows)
+        return JSim
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_truth_worker, initargs=init_args) as pool:
+        for start, rows in pool.map(calc_JSim_block, bounds):
+            JSim.set_rows(start, rows)
+    return JSim
 
-    JSim = [[0 for x in range(data_size)] for y in range(data_size)]
-    user_ids = []
 
-    for counter, user in enumerate(data.keys()):
-        user_ids.append(user)
+def set_initial_JSim(data, data_size, filename_truth, fingerprint=None, workers=None):
+    """Fills in the JSim Matrix and writes it to a binary truth file.
+    Returns the JSim Matrix."""
 
-        for other_counter, other_user in enumerate(data.keys()):
-            if user == other_user:
-                continue
-            if counter > other_counter:
-                JSim[counter][other_counter] = JSim[other_counter][counter]
-                continue
+    JSim = calc_JSim(data, workers=workers)
+    print('Writing to file '+ filename_truth)
+    write_JSim(filename_truth, JSim, list(data.keys()), fingerprint)
+    return JSim
 
-            JSim[counter][other_counter] = calc_Jacc(data[user], data[other_user])
 
-    counter = 0
+def write_JSim(filename, JSim, user_ids, fingerprint=None):
+    """Writes a SimMatrix to a binary truth file, replacing it atomically."""
+    header = {'size': JSim.size, 'dtype': JSim.dtype.str, 'user_ids': [int(id) for id in user_ids],
+              'fingerprint': fingerprint}
+    header = json.dumps(header).encode()
+    pad = -(len(TRUTH_MAGIC) + 8 + len(header)) % TRUTH_ALIGN
+    header += b' ' * pad
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'wb') as t:
+        t.write(TRUTH_MAGIC)
+        t.write(len(header).to_bytes(8, 'little'))
+        t.write(header)
+        t.write(np.ascontiguousarray(JSim.data).tobytes())
+    os.replace(filename + '.tmp', filename)
+
+
+def read_JSim_header(filename):
+    """Returns the header of a binary truth file and the offset of its data."""
+    with open(filename, 'rb') as t:
+        if t.read(len(TRUTH_MAGIC)) != TRUTH_MAGIC:
+            raise ValueError(filename + ' is not a binary truth file')
+        length = int.from_bytes(t.read(8), 'little')
+        header = json.loads(t.read(length))
+    return header, len(TRUTH_MAGIC) + 8 + length
+
+
+def is_current(filename, fingerprint, user_ids=None):
+    """Returns true if the truth file exists, holds all its similarities and
+    was made from the data file with the given fingerprint. If user_ids are
+    given, the rows of the truth must also be these users in this order."""
+    if not os.path.exists(filename):
+        return False
+    try:
+        header, offset = read_JSim_header(filename)
+        size = header['size']
+        expected = offset + size * (size - 1) // 2 * np.dtype(header['dtype']).itemsize
+    except (ValueError, KeyError, TypeError):
+        return False
+    if user_ids is not None and header.get('user_ids') != [int(id) for id in user_ids]:
+        return False
+    return header['fingerprint'] == fingerprint and os.path.getsize(filename) == expected
 
-    with open(filename_truth, 'w') as t:
-        print('Writing to file '+ '../JSims/'+filename_truth)
-        header = '\t' + ('\t'.join([str(id) for id in data.keys()]))
-        user_list = [str(id) for id in data.keys()]
-        print(len(user_list), len(JSim))
-        t.write(header + '\n')
-        for i in range(len(JSim)):
-            t.write(user_list[i]+'\t')
-            counter += 1
-            for j in range(len(JSim)):
-                t.write(str(round(JSim[i][j], 5)))
-                if j < len(JSim) - 1:
-                    t.write("\t")
-                else:
-                    t.write("\n")
 
+def set_JSim(data_size, filename):
+    """Reads in from JSim file and returns a SimMatrix containing the
+    Jaccard similarity. Binary truth files are memory mapped, tab-separated
+    .txt files are parsed."""
 
+    if filename.endswith('.txt'):
+        return read_JSim_txt(data_size, filename)[0]
+    header, offset = read_JSim_header(filename)
+    size = header['size']
+    data = np.memmap(filename, dtype=np.dtype(header['dtype']), mode='r', offset=offset,
+                     shape=(size * (size - 1) // 2,))
+    return sm.SimMatrix(size, data)
 
-def set_JSim(data_size, filename):
-    """Reads in from JSim file and returns JSim matrix containing the
-    Jaccard similarity."""
 
-    JSim = [[0 for x in range(data_size)] for y in range(data_size)]
+def read_JSim_txt(data_size, filename):
+    """Parses a tab-separated truth file. Returns the SimMatrix and the user IDs."""
+
+    JSim = sm.SimMatrix(data_size)
     
     with open(filename) as t:
-        next(t)
+        user_ids = [int(id) for id in next(t).split('\t')[1:]]
         i = 0
         for row in t:
-            JSims = (row.split('\t'))[1:]
-            for j in range(len(JSims)):
-                JSim[i][j] = float(JSims[j])
+            JSims = (row.split('\t'))[i + 2:]
+            start = JSim.row_start(i)
+            JSim.data[start:start + len(JSims)] = np.array(JSims, dtype=np.float64)
             i += 1
-    return JSim
- 
-
-
-
+    return JSim, user_ids
+
+
+def convert_JSim_txt(filename_txt, filename_bin=None, data_file=None):
+    """Converts a tab-separated truth file to the binary format. If the data file
+    it was computed from is given, its fingerprint is stored so that the file
+    is recognised as current; the users of the truth must then be the users of
+    the data file in the same order."""
+    if filename_bin is None:
+        filename_bin = filename_txt.replace('.txt', '.bin')
+    with open(filename_txt) as t:
+        data_size = len(next(t).split('\t')) - 1
+    JSim, user_ids = read_JSim_txt(data_size, filename_txt)
+    fingerprint = None
+    if data_file is not None:
+        if user_ids != dr.read_data(data_file).keys():
+            raise ValueError(filename_txt + ' does not hold the users of ' + data_file + ' in their order')
+        fingerprint = dr.file_fingerprint(dr.data_path(data_file))
+    write_JSim(filename_bin, JSim, user_ids, fingerprint)
+    return filename_bin
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts JSims/*_truth.txt files to the binary truth format.')
+    parser.add_argument('truth', nargs='+', help='Tab-separated truth files')
+    parser.add_argument('-s', '--set', help='Data file the truth was computed from, e.g. lastfm.dat')
+    args = parser.parse_args()
+    for filename in args.truth:
+        print('Wrote', convert_JSim_txt(filename, data_file=args.set))
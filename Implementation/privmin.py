@@ -1,7 +1,8 @@
 import random
 import math
-import datareader as dr
+import numpy as np
 import minhash as mh
+import profiling as prof
 
 
 # =============================================================================
@@ -9,13 +10,19 @@ import minhash as mh
 # =============================================================================
 # Generates MinHash signatures using the exponential mechanism to choose
 # returned hash values. Shrinks output range based on range parameter as in Yan.
+# The output distribution of get_return_val only depends on the length of the
+# shrunk list, so signatures are sampled for all users at once from a cached
+# CDF over ranks, using one random draw per signature value. The sorted
+# shrunk lists come from the base hashes shared with MinHash.
 
 class PrivMin(mh.MinHash):
+  exact_mins = False
 
-  def __init__(self, num_hashes, users, eps):
-      mh.MinHash.__init__(self, num_hashes, users)
+  def __init__(self, num_hashes, users, eps, seed=None, base_cache=None):
+      mh.MinHash.__init__(self, num_hashes, users, seed, base_cache)
       self.eps = eps
-      self.range = (dr.avg_set_size(users) / 1.995) ** (-eps)
+      self.range = (self.users.avg_set_size / 1.995) ** (-eps)
+      self.rank_cdfs = {}
       
    
   def shrink_output_range(self, hash_vals):
@@ -56,6 +63,7 @@ class PrivMin(mh.MinHash):
     """Chooses and returns a hash value based on exponential mechanism."""
     hash_returned = False
     while not hash_returned:
+      prof.count('exp_mech_sweeps')
       for r, val in enumerate(hash_vals):
         if self.is_chosen(exp_sum, self.util(hash_vals,r), delta_util):
           hash_returned = True
@@ -71,5 +79,50 @@ class PrivMin(mh.MinHash):
     exp_sum = self.get_exp_sum(hash_vals, delta_util)
     return self.get_return_val(hash_vals, exp_sum, delta_util)
 
-  
-            
\ No newline at end of file
+
+  def shrunk_length(self, set_size):
+    """Returns the length of a hash value list of set_size after shrink_output_range."""
+    return min(set_size, math.ceil(set_size*self.range))
+
+
+  def get_rank_cdf(self, length):
+    """Returns the CDF of the rank returned by get_return_val for a shrunk list
+    of the given length. Each sweep of the rejection loop picks rank r with
+    probability prob_r * prod_{j<r}(1 - prob_j), restarting if nothing is picked."""
+    if length not in self.rank_cdfs:
+      ranks = np.arange(length)
+      weights = np.exp((self.eps * (length - ranks)) / (2 * self.num_hashes * length))
+      probs = weights / weights.sum()
+      not_before = np.concatenate(([1.0], np.cumprod(1 - probs)[:-1]))
+      cdf = np.cumsum(probs * not_before)
+      self.rank_cdfs[length] = cdf / cdf[-1]
+    return self.rank_cdfs[length]
+
+
+  def sample_ranks(self, length, shape, rng):
+    """Draws ranks in the shrunk list with the distribution of get_return_val."""
+    ranks = np.searchsorted(self.get_rank_cdf(length), rng.random(shape), side='right')
+    return np.minimum(ranks, length - 1)
+
+
+  def get_minHash_sig_matrix(self):
+    return self.get_trial_sig_matrices(1)[0]
+
+
+  def get_trial_base(self):
+    """Returns the shortened lists of smallest hash values and their lengths."""
+    sizes = self.users.set_sizes
+    lengths = np.minimum(sizes, np.ceil(sizes * self.range)).astype(np.int64)
+    return lengths, self.get_base_hashes(lengths)
+
+
+  def get_trial_sig_matrices(self, trials, base=None):
+    """Selects a hash value per trial, user and hash function with the
+    exponential mechanism from the sorted shortened lists of smallest values."""
+    lengths, base = self.get_trial_base() if base is None else base
+    sigs = np.empty((trials, self.data_size, self.num_hashes), dtype=base.values.dtype)
+    for length, rows, vals in base.iter_length_groups(lengths):
+      ranks = self.sample_ranks(length, (trials, len(rows), self.num_hashes), self.rng)
+      prof.count('exp_mech_draws', ranks.size)
+      sigs[:, rows] = np.take_along_axis(vals[None], ranks[:, :, None, :], axis=2)[:, :, 0, :]
+    return sigs
@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# =============================================================================
+#                 Stage Profiling
+# =============================================================================
+# Records wall time, CPU time, peak resident memory and the peak of memory
+# allocated through tracemalloc for named stages of a run, together with the
+# hot-path counters incremented by the algorithms while the stage ran. Each
+# stage can also be profiled with cProfile into its own .prof file.
+# The peak resident memory is reset per stage where Linux allows it, otherwise
+# it is the peak of the process so far.
+
+counters = collections.Counter()
+
+
+def count(name, n=1):
+    """Adds n to a hot-path counter."""
+    counters[name] += n
+
+
+def counted(func, *args):
+    """Calls func and returns its result with the counters it incremented, so
+    counts of worker processes can be merged in the parent with merge."""
+    before = counters.copy()
+    result = func(*args)
+    return result, dict(counters - before)
+
+
+def merge(counts):
+    counters.update(counts)
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory reported by /proc/self/status."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Returns the peak resident memory in bytes, or None if it is unknown."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    def __init__(self, cprofile_dir=None):
+        """cprofile_dir optionally receives a <stage>.prof file per stage."""
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures the code run inside the with block as stage name."""
+        before = counters.copy()
+        reset_peak_rss()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        profile = cProfile.Profile() if self.cprofile_dir is not None else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            record = {'stage': name,
+                      'wall_seconds': time.perf_counter() - wall,
+                      'cpu_seconds': time.process_time() - cpu,
+                      'peak_rss_bytes': peak_rss(),
+                      'peak_traced_bytes': tracemalloc.get_traced_memory()[1],
+                      'counters': dict(counters - before)}
+            if not tracing:
+                tracemalloc.stop()
+            if profile is not None:
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                record['cprofile'] = os.path.join(self.cprofile_dir, name + '.prof')
+                profile.dump_stats(record['cprofile'])
+            self.stages.append(record)
+
+
+    def report(self, **meta):
+        """Returns the stages and the total of every counter as a dict."""
+        totals = collections.Counter()
+        for record in self.stages:
+            totals.update(record['counters'])
+        return dict(meta, stages=self.stages, counters=dict(totals))
+
+
+    def write(self, filename, **meta):
+        with open(filename, 'w') as f:
+            json.dump(self.report(**meta), f, indent=1)
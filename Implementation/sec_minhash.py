@@ -1,24 +1,32 @@
-import random
 import math
+import numpy as np
 import minhash as mh
+import profiling as prof
+import signatures as sg
 
 
 # =============================================================================
 #                 Generate signatures by Secure MinHash
 # =============================================================================
 # Concatenates k minimum hash values, maps them to 1 bit and
-# returns signature of length L.
+# returns signature of length L. The L x k minimum hash values are computed for
+# blocks of users and repetitions at once and mapped to bits in one batch.
+# The bits are packed into uint64 words, so similarities are computed with XOR
+# and popcount.
 
 
 class Sec_MinHash(mh.MinHash):
-  def __init__(self, num_hashes, users, L):
-    mh.MinHash.__init__(self, num_hashes, users)
+  exact_mins = False
+  sparse_collisions = False
+
+  def __init__(self, num_hashes, users, L, seed=None):
+    mh.MinHash.__init__(self, num_hashes, users, seed)
     self.L = L # length of signature
     self.rand_ints = None
 
 
   def pick_random_ints(self):
-    return [random.randint(0, self.next_prime) for x in range(self.num_hashes+1)]
+    return [self.rand_int() for x in range(self.num_hashes+1)]
 
   def setup(self):
     self.rand_ints = [self.pick_random_ints() for x in range(self.L + 1)]
@@ -27,6 +35,7 @@ class Sec_MinHash(mh.MinHash):
 
 
   def hash_item(self, item, k, l):
+    prof.count('hash_evals')
     val = ((self.coeffA[l][k] * item + self.coeffB[l][k]) % self.next_prime) % self.highest_ID
     return val
 
@@ -53,14 +62,77 @@ class Sec_MinHash(mh.MinHash):
         signature.append(self.get_min_hash_val(hash_vals))
       uni_signature.append(self.hash_universal(signature, k, l))
     return uni_signature
+
+
+  def hash_universal_matrix(self, min_vals, ls):
+    """Vectorized hash_universal. Maps the (n_users x len(ls) x k) minimum hash
+    values of repetitions ls to bits, reducing each product modulo the prime."""
+    p = np.uint64(self.next_prime)
+    rand_ints = np.asarray(self.rand_ints, dtype=np.uint64)[ls] % p
+    terms = mh.mersenne_mod(min_vals.astype(np.uint64) * rand_ints[None, :, :self.num_hashes], self.next_prime)
+    uni = terms.sum(axis=2) + rand_ints[None, :, self.num_hashes]
+    return (mh.mersenne_mod(uni, self.next_prime) % np.uint64(2)).astype(np.int64)
+
+
+  def iter_user_blocks(self):
+    """Yields slices of users whose items times num_hashes fit into
+    MAX_BLOCK_CELLS; a single larger user forms a block of its own."""
+    indptr = self.users.indptr
+    cells = max(1, mh.MAX_BLOCK_CELLS // self.num_hashes)
+    start = 0
+    while start < self.data_size:
+      stop = int(np.searchsorted(indptr, indptr[start] + cells, side='right')) - 1
+      stop = min(max(stop, start + 1), start + cells, self.data_size)
+      yield slice(start, stop)
+      start = stop
+
+
+  def iter_bit_blocks(self):
+    """Yields blocks of users and repetitions and their (len(rows) x len(ls))
+    signature bits. The items of a block of users are hashed for as many
+    repetitions at a time as keep every array within MAX_BLOCK_CELLS."""
+    coeffA = np.asarray(self.coeffA)
+    coeffB = np.asarray(self.coeffB)
+    for rows in self.iter_user_blocks():
+      users = self.users.slice(rows.start, rows.stop)
+      width = max(len(users.indices), users.num_users) * self.num_hashes
+      block = max(1, mh.MAX_BLOCK_CELLS // width)
+      for start in range(0, self.L, block):
+        ls = np.arange(start, min(start + block, self.L))
+        hashes = self.hash_items(users.item_ids, coeffA[ls].ravel(), coeffB[ls].ravel())
+        min_vals = mh.segment_min(hashes, users.indices, users.indptr)
+        yield rows, ls, self.hash_universal_matrix(min_vals.reshape(-1, len(ls), self.num_hashes), ls)
+
+
+  def get_minHash_sig_matrix(self):
+    """Returns the signatures of all users packed into (n_users x L/64) uint64 words."""
+    words = np.zeros((self.data_size, -(-self.L // 64)), dtype=np.uint64)
+    for rows, ls, bits in self.iter_bit_blocks():
+      bits = bits.astype(np.uint64)
+      for j, l in enumerate(ls.tolist()):
+        words[rows, l // 64] |= bits[:, j] << np.uint64(l % 64)
+    return words
+
+
+  def make_signatures(self, matrix):
+    return sg.PackedSignatures(self.users.keys(), matrix, self.L)
         
 
   def calc_est_Jacc(self, sig, other_sig):
-    """Receives two signatures and returns their estimated Jaccard
+    """Receives two packed signatures and returns their estimated Jaccard
     similarity computed by a debiased estimator."""
-    collisions = 0
-    for i in range(len(sig)):
-            collisions += (sig[i] == other_sig[i])
+    collisions = self.L - int(sg.popcount(sig ^ other_sig).sum())
     est_Jacc = 2*(collisions/self.L) -1 
     return est_Jacc
 
+
+  def count_collisions(self, words, other_words):
+    """Returns the matrix of equal bits between the rows of two packed
+    signature matrices, i.e. L minus their Hamming distances."""
+    diff = words[:, None, :] ^ other_words[None, :, :]
+    return self.L - sg.popcount(diff).sum(axis=2, dtype=np.int64)
+
+
+  def calc_est_Jacc_block(self, sigs, other_sigs):
+    return 2*(self.count_collisions(sigs, other_sigs)/self.L) - 1
+
@@ -0,0 +1,75 @@
+import numpy as np
+
+# =============================================================================
+#                 Signature Matrix
+# =============================================================================
+# Holds the signatures of all users as one (n_users x signature length) array
+# together with the mapping from user IDs to rows. Signatures of single bits
+# are packed into uint64 words and compared with XOR and popcount.
+
+
+class Signatures:
+    def __init__(self, user_ids, matrix):
+        self.user_ids = list(user_ids)
+        self.matrix = matrix
+        self.id_to_idx = {user: idx for idx, user in enumerate(self.user_ids)}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __contains__(self, user):
+        return user in self.id_to_idx
+
+    def __getitem__(self, user):
+        """Returns the signature row of a user ID."""
+        return self.matrix[self.id_to_idx[user]]
+
+    def keys(self):
+        return list(self.user_ids)
+
+    def values(self):
+        return [self.matrix[idx] for idx in range(len(self.user_ids))]
+
+    def items(self):
+        return [(user, self.matrix[idx]) for idx, user in enumerate(self.user_ids)]
+
+
+class PackedSignatures(Signatures):
+    """Bit signatures of the given length, packed into rows of uint64 words."""
+
+    def __init__(self, user_ids, words, length):
+        Signatures.__init__(self, user_ids, words)
+        self.length = length
+
+    def unpack(self):
+        """Returns the (n_users x length) matrix of bits."""
+        return unpack_bits(self.matrix, self.length)
+
+
+def pack_bits(bits):
+    """Packs a (n x L) matrix of bits into (n x ceil(L/64)) uint64 words."""
+    bits = np.asarray(bits, dtype=np.uint8)
+    num_words = -(-bits.shape[1] // 64)
+    padded = np.zeros((bits.shape[0], num_words * 64), dtype=np.uint8)
+    padded[:, :bits.shape[1]] = bits
+    return np.packbits(padded, axis=1, bitorder='little').view('<u8')
+
+
+def unpack_bits(words, length):
+    """Inverse of pack_bits."""
+    bytes_ = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+    return np.unpackbits(bytes_, axis=-1, bitorder='little')[..., :length]
+
+
+_BYTE_COUNTS = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """Returns the number of set bits of each uint64 word."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    bytes_ = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+    return _BYTE_COUNTS[bytes_].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
@@ -0,0 +1,185 @@
+import numpy as np
+import scipy.sparse
+import datareader as dr
+
+# =============================================================================
+#                 Exact Top-N Neighbours by Similarity Join
+# =============================================================================
+# Computes the exact N most similar users of every user without the full
+# similarity matrix. Items of every user are ordered from rare to frequent.
+# A first pass probes only the rarest items of each user to find N similar
+# users; the N-th best of them is a lower bound t of the user's threshold.
+# Every user v with Jaccard similarity >= t shares an item with the prefix of
+# the first |u| - ceil(t|u|) + 1 items of u, so the second pass only
+# considers users sharing a prefix item. Both passes work on blocks of users:
+# a sparse product of the prefixes with the user x item matrix yields the
+# candidates and their shared prefix items, and the shared items of the
+# remaining suffixes are added by a product limited to the candidate pairs.
+
+BOUND_PROBES = 4  # first pass probes items until N * BOUND_PROBES postings
+MAX_BLOCK_PROBES = 2**22
+
+
+class Neighbours:
+    """Top-N neighbours of each user: (n_users x N) row indices, sorted by
+    decreasing similarity with ties broken by lower index, and their scores.
+    Index -1 marks a missing neighbour."""
+
+    def __init__(self, indices, scores):
+        self.indices = indices
+        self.scores = scores
+        self.size = len(indices)
+        self.N = indices.shape[1]
+
+    def __len__(self):
+        return self.size
+
+    def mask(self, start, stop, N=None):
+        """Returns a boolean (stop-start x n_users) mask of the first N neighbours
+        of users start..stop."""
+        mask = np.zeros((stop - start, self.size), dtype=bool)
+        rows = self.indices[start:stop, :N]
+        valid = rows >= 0
+        mask[np.nonzero(valid)[0], rows[valid]] = True
+        return mask
+
+
+def sort_by_frequency(data):
+    """Returns the CSR item arrays with each user's items ordered from the least
+    to the most frequent item."""
+    rank = np.empty(data.num_items, dtype=np.int64)
+    rank[np.argsort(data.item_freq, kind='stable')] = np.arange(data.num_items)
+    rows = np.repeat(np.arange(data.num_users, dtype=np.int64), data.set_sizes)
+    order = np.argsort(rows * data.num_items + rank[data.indices])
+    return data.indptr.astype(np.int64), data.indices[order]
+
+
+def row_positions(indptr):
+    """Returns the position of every entry of a CSR array within its row."""
+    sizes = np.diff(indptr)
+    return np.arange(indptr[-1]) - np.repeat(indptr[:-1], sizes)
+
+
+def split_rows(indptr, items, lengths, num_items):
+    """Returns the first lengths[u] items of every row and the remaining items
+    as two sparse user x item matrices."""
+    sizes = np.diff(indptr)
+    in_prefix = row_positions(indptr) < np.repeat(lengths, sizes)
+    matrices = []
+    for part, counts in ((in_prefix, lengths), (~in_prefix, sizes - lengths)):
+        part_ptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=part_ptr[1:])
+        matrices.append(scipy.sparse.csr_matrix((np.ones(int(part.sum()), dtype=np.float32), items[part], part_ptr),
+                                                shape=(len(sizes), num_items)))
+    return matrices
+
+
+def prefix_sums(indptr, values, lengths):
+    """Returns the sum of the first lengths[u] values of every row."""
+    in_prefix = row_positions(indptr) < np.repeat(lengths, np.diff(indptr))
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return np.bincount(rows, weights=np.where(in_prefix, values, 0), minlength=len(indptr) - 1).astype(np.int64)
+
+
+def probe_blocks(probes):
+    """Yields slices of users whose probed postings fit MAX_BLOCK_PROBES."""
+    bounds = np.zeros(len(probes) + 1, dtype=np.int64)
+    np.cumsum(probes, out=bounds[1:])
+    start = 0
+    while start < len(probes):
+        stop = int(np.searchsorted(bounds, bounds[start] + MAX_BLOCK_PROBES, side='right')) - 1
+        stop = max(stop, start + 1)
+        yield slice(start, stop)
+        start = stop
+
+
+def join_blocks(users, users_T, prefix, suffix, sizes, probes, thresholds=None, verify=True):
+    """Yields, for blocks of users u, the pairs (u, v) sharing an item of the
+    prefix of u, ordered by u and v, and their Jaccard similarities. Shared
+    prefix items come from a sparse product of the prefixes with the item x
+    user matrix; if verify, the shared items of the suffixes are added by a
+    product limited to the pairs, otherwise the similarities are lower bounds.
+    With thresholds, only pairs with a similarity of at least thresholds[u]
+    are yielded; pairs whose shared prefix items rule that out are dropped
+    before the suffixes are compared."""
+    suffix_sizes = np.diff(suffix.indptr)
+    for block in probe_blocks(probes):
+        shared = prefix[block] @ users_T
+        shared.sort_indices()
+        first = block.start + np.repeat(np.arange(shared.shape[0]), np.diff(shared.indptr))
+        second, counts = shared.indices, shared.data.astype(np.int64)
+        keep = first != second
+        open_rows = suffix_sizes[block] > 0
+        if verify and thresholds is not None and open_rows.any():
+            t = thresholds[first]
+            most = counts + np.minimum(suffix_sizes[first], sizes[second] - counts)
+            keep &= most >= (t - 1e-9) * (sizes[first] + sizes[second] - most)
+        first, second, counts = first[keep], second[keep], counts[keep]
+        if verify and open_rows.any():
+            pending = np.flatnonzero(open_rows[first - block.start])
+            counts[pending] += np.asarray(suffix[first[pending]].multiply(users[second[pending]])
+                                          .sum(axis=1)).ravel().astype(np.int64)
+        sims = counts / (sizes[first] + sizes[second] - counts)
+        if thresholds is not None:
+            keep = sims >= thresholds[first]
+            first, second, sims = first[keep], second[keep], sims[keep]
+        yield first, second, sims
+
+
+def select_top(first, second, sims, indices, scores):
+    """Writes the best pairs of every user in first into its row of indices
+    and scores, by decreasing similarity with ties broken by lower index. The
+    pairs must be ordered by first and then by second, so a stable sort of the
+    row offset minus the similarity orders every row."""
+    N = indices.shape[1]
+    if len(first) == 0:
+        return
+    order = np.argsort(2.0 * (first - first[0]) - sims, kind='stable')
+    first, second, sims = first[order], second[order], sims[order]
+    rank = np.arange(len(first)) - np.searchsorted(first, first)
+    top = rank < N
+    indices[first[top], rank[top]] = second[top]
+    scores[first[top], rank[top]] = sims[top]
+
+
+def top_N_neighbours(data, N=20):
+    """Returns the exact top N Jaccard neighbours of all users as Neighbours.
+    Users sharing items with fewer than N users keep -1 in the remaining
+    places: users of similarity 0 are never true neighbours."""
+    data = dr.as_dataset(data)
+    n = data.num_users
+    N = min(N, n - 1)
+    sizes = data.set_sizes.astype(np.int64)
+    indptr, items = sort_by_frequency(data)
+    users = scipy.sparse.csr_matrix((np.ones(len(data.indices), dtype=np.float32), data.indices, data.indptr),
+                                    shape=(n, data.num_items))
+    users_T = users.T.tocsr()
+    postings = data.item_freq[items].astype(np.int64)
+    indices = np.full((n, N), -1, dtype=np.int32)
+    scores = np.zeros((n, N), dtype=np.float32)
+
+    # first pass: a lower bound of the N-th best similarity from the shared
+    # items among the rarest items, probed until their postings reach
+    # N * BOUND_PROBES
+    before = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum(postings, out=before[1:])
+    before = before[:-1] - np.repeat(before[indptr[:-1]], sizes)
+    lengths = np.bincount(np.repeat(np.arange(n), sizes), weights=before < N * BOUND_PROBES, minlength=n)
+    lengths = np.clip(lengths.astype(np.int64), 1, sizes)
+    prefix, suffix = split_rows(indptr, items, lengths, data.num_items)
+    probes = prefix_sums(indptr, postings, lengths)
+    for pairs in join_blocks(users, users_T, prefix, suffix, sizes, probes, verify=False):
+        select_top(*pairs, indices, scores)
+    thresholds = scores[:, -1].astype(np.float64) * (1 - 1e-6)
+
+    # second pass: every user at or above the bound
+    lengths = sizes - np.ceil(thresholds * sizes - 1e-9).astype(np.int64) + 1
+    lengths = np.clip(lengths, 1, sizes)
+    prefix, suffix = split_rows(indptr, items, lengths, data.num_items)
+    probes = prefix_sums(indptr, postings, lengths)
+    indices[:] = -1
+    scores[:] = 0
+    for first, second, sims in join_blocks(users, users_T, prefix, suffix, sizes, probes, thresholds):
+        found = sims > 0
+        select_top(first[found], second[found], sims[found], indices, scores)
+    return Neighbours(indices, scores)
@@ -0,0 +1,189 @@
+import numpy as np
+
+# =============================================================================
+#                 Similarity Matrix
+# =============================================================================
+# Stores a symmetric similarity matrix with zero diagonal as its condensed
+# upper triangle: the entries (i, j) with i < j, row by row. Rows, pairs and
+# blocks of rows are expanded from the condensed array on access.
+# Everything that yields blocks of rows through iter_blocks can be used as a
+# source of similarities, including dense (memory-mapped) arrays and
+# estimates computed tile by tile from signatures.
+
+
+class SimMatrix:
+    def __init__(self, size, data=None, dtype=np.float32):
+        self.size = size
+        if data is None:
+            data = np.zeros(size * (size - 1) // 2, dtype=dtype)
+        self.data = data
+        self.dtype = data.dtype
+
+    @classmethod
+    def from_dense(cls, matrix, dtype=np.float32):
+        """Builds a SimMatrix from the upper triangle of a square matrix."""
+        matrix = np.asarray(matrix)
+        sim = cls(len(matrix), dtype=dtype)
+        sim.set_rows(0, matrix)
+        return sim
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        """JSim[i] returns row i, JSim[i, j] a single pair."""
+        if isinstance(key, tuple):
+            return self.pair(*key)
+        return self.row(key)
+
+    def row_start(self, i):
+        """Returns the position of the pair (i, i+1) in the condensed array."""
+        return i * self.size - i * (i + 1) // 2
+
+    def pair(self, i, j):
+        if i == j:
+            return self.dtype.type(0)
+        i, j = min(i, j), max(i, j)
+        return self.data[self.row_start(i) + j - i - 1]
+
+    def row(self, i):
+        """Returns row i as a dense array."""
+        row = np.zeros(self.size, dtype=self.dtype)
+        before = np.arange(i)
+        row[:i] = self.data[self.row_start(before) + i - before - 1]
+        start = self.row_start(i)
+        row[i + 1:] = self.data[start:start + self.size - i - 1]
+        return row
+
+    def rows(self, start, stop):
+        """Returns rows start to stop as a dense (stop-start x size) array."""
+        return np.array([self.row(i) for i in range(start, min(stop, self.size))], dtype=self.dtype).reshape(-1, self.size)
+
+    def set_rows(self, start, rows):
+        """Writes the upper triangle part of dense rows beginning at row start.
+        Rows may cover only the columns from start onwards."""
+        offset = self.size - rows.shape[1]
+        for r in range(len(rows)):
+            i = start + r
+            begin = self.row_start(i)
+            self.data[begin:begin + self.size - i - 1] = rows[r, i + 1 - offset:]
+
+    def set_row(self, i, row):
+        """Writes a full dense row i, i.e. row and column i of the matrix."""
+        before = np.arange(i)
+        self.data[self.row_start(before) + i - before - 1] = row[:i]
+        start = self.row_start(i)
+        self.data[start:start + self.size - i - 1] = row[i + 1:]
+
+    def resized(self, size):
+        """Returns a copy with size users; new rows and columns are zero."""
+        sim = SimMatrix(size, dtype=self.dtype)
+        for i in range(min(size, self.size) - 1):
+            length = min(size, self.size) - i - 1
+            sim.data[sim.row_start(i):sim.row_start(i) + length] = self.data[self.row_start(i):self.row_start(i) + length]
+        return sim
+
+    def iter_blocks(self, block_size=256, upper=False):
+        """Yields (start, stop, rows) for consecutive blocks of dense rows.
+        If upper is set, rows only cover the columns from start onwards."""
+        for start in range(0, self.size, block_size):
+            stop = min(start + block_size, self.size)
+            if upper:
+                rows = np.zeros((stop - start, self.size - start), dtype=self.dtype)
+                for i in range(start, stop):
+                    begin = self.row_start(i)
+                    rows[i - start, i - start + 1:] = self.data[begin:begin + self.size - i - 1]
+                yield start, stop, rows
+            else:
+                yield start, stop, self.rows(start, stop)
+
+    def to_dense(self):
+        return self.rows(0, self.size)
+
+
+def as_sim_matrix(matrix, dtype=np.float32):
+    """Returns matrix as a SimMatrix, converting dense arrays and nested lists."""
+    if isinstance(matrix, SimMatrix):
+        return matrix
+    return SimMatrix.from_dense(matrix, dtype=dtype)
+
+
+class DenseRows:
+    """Row block source over a square matrix, e.g. an np.memmap of similarities."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.size = len(matrix)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.matrix[key]
+
+    def iter_blocks(self, block_size=256, upper=False):
+        for start in range(0, self.size, block_size):
+            stop = min(start + block_size, self.size)
+            first = start if upper else 0
+            yield start, stop, np.asarray(self.matrix[start:stop, first:])
+
+
+class EstimatedSims:
+    """Row block source computing estimated similarities from signatures when a
+    block is requested, so the full estimate never has to be held in memory.
+    The signatures may be a (trials x n_users x length) stack of independent
+    trials; blocks then hold the estimates of every trial. Algorithms whose
+    estimates only depend on the numbers of equal positions count them by a
+    sparse product of a block of rows with the collision matrix of all users."""
+
+    def __init__(self, MH_algo, user_to_sig, tile_size=256, dtype=np.float32):
+        self.MH_algo = MH_algo
+        self.sigs = user_to_sig.matrix
+        self.trial_sigs = self.sigs.reshape((-1,) + self.sigs.shape[-2:])
+        self.size = self.sigs.shape[-2]
+        self.tile_size = tile_size
+        self.dtype = dtype
+        self.collisions = None
+        if getattr(MH_algo, 'sparse_collisions', False):
+            matrices = [MH_algo.collision_matrix(sigs) for sigs in self.trial_sigs]
+            self.collisions = [(matrix, matrix.T.tocsr()) for matrix in matrices]
+
+    def __len__(self):
+        return self.size
+
+    def block(self, start, stop, first=0):
+        """Returns the estimated similarities of rows start..stop to the users
+        from first onwards as dtype, like the stored SimMatrix, with zero
+        diagonal."""
+        if self.collisions is not None:
+            counts = np.stack([(matrix[start:stop] @ matrix_T).toarray()[:, first:]
+                               for matrix, matrix_T in self.collisions])
+            block = self.MH_algo.calc_est_from_collisions(counts).astype(self.dtype)
+        else:
+            block = np.stack([self.tiled_block(sigs, start, stop, first) for sigs in self.trial_sigs])
+        block = block.reshape(self.sigs.shape[:-2] + block.shape[1:])
+        block[..., np.arange(stop - start), np.arange(start - first, stop - first)] = 0
+        return block
+
+    def tiled_block(self, sigs, start, stop, first):
+        """Returns the estimates of rows start..stop of one signature matrix, a
+        tile of tile_size users at a time."""
+        rows = sigs[start:stop]
+        tiles = [self.MH_algo.calc_est_Jacc_block(rows, sigs[col:col + self.tile_size])
+                 for col in range(first, self.size, self.tile_size)]
+        return np.hstack(tiles).astype(self.dtype)
+
+    def iter_blocks(self, block_size=256, upper=False):
+        for start in range(0, self.size, block_size):
+            stop = min(start + block_size, self.size)
+            yield start, stop, self.block(start, stop, start if upper else 0)
+
+
+def as_row_source(matrix):
+    """Returns matrix as something with iter_blocks. Arrays, including memory
+    maps, are read block by block; nested lists are condensed."""
+    if hasattr(matrix, 'iter_blocks'):
+        return matrix
+    if isinstance(matrix, np.ndarray):
+        return DenseRows(matrix)
+    return as_sim_matrix(matrix)
@@ -0,0 +1,151 @@
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import itertools
+import json
+import os
+import basehash as bh
+import datareader as dr
+import main
+
+# =============================================================================
+#                 Parameter Sweeps
+# =============================================================================
+# Runs one algorithm over a grid of parameters and seeds. The dataset and its
+# ground truth are loaded once per process, grid points run in parallel, and
+# the measures of every point are cached on disk under a key of the dataset
+# fingerprint, algorithm, parameters and seed, so an interrupted sweep resumes
+# where it stopped. Points of MinHash, PrivMin and Bucket PrivMin with equal k
+# and seed share their base hashes within a worker process.
+# Results are returned as one row per point.
+
+CACHE_DIR = 'sweeps/'
+MEASURES = ['MSE', 'precision', 'recall', 'F1']
+PARAMS = ['num_hashes', 'eps', 'delta', 'l', 'b', 'alpha', 'num_buckets']
+
+_data = None
+_JSim = None
+_base_cache = None
+
+
+def expand_grid(grid):
+    """Returns all combinations of a mapping from parameter names to lists of
+    values, as a list of parameter dicts."""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def point_key(fingerprint, algorithm, params, seed):
+    """Returns the cache key of a grid point."""
+    point = {'fingerprint': fingerprint, 'algorithm': algorithm, 'params': params, 'seed': seed}
+    return hashlib.sha1(json.dumps(point, sort_keys=True).encode()).hexdigest()
+
+
+def cache_file(cache_dir, key):
+    return os.path.join(cache_dir, key + '.json')
+
+
+def load_result(cache_dir, key):
+    """Returns the cached measures of a grid point, or None if it has not run."""
+    try:
+        with open(cache_file(cache_dir, key)) as f:
+            return json.load(f)['measures']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_result(cache_dir, key, point, measures):
+    """Writes the measures of a grid point, replacing the file atomically."""
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_file(cache_dir, key)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'point': point, 'measures': measures}, f, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def init_sweep_worker(data_file):
+    """Loads the dataset and ground truth once per worker process."""
+    global _data, _JSim, _base_cache
+    _data, _JSim = main.setup(data_file)
+    _base_cache = bh.BaseHashCache()
+
+
+def run_point(point):
+    """Runs one grid point on the loaded dataset and returns its measures."""
+    analysis = main.main(_data, _JSim, point['algorithm'], seed=point['seed'],
+                         base_cache=_base_cache, **point['params'])
+    prec, recall, f1 = analysis.PRF()
+    return {'MSE': analysis.MSE(), 'precision': prec, 'recall': recall, 'F1': f1}
+
+
+def run_sweep(data_file, algorithm, grid, seeds=(0,), workers=None, cache_dir=CACHE_DIR):
+    """Runs algorithm (a minhash_type of main.hashing) for every point of grid and
+    every seed. Points found in the cache are not run again. Returns a list of
+    result rows with the dataset, algorithm, seed, parameters and measures."""
+    fingerprint = dr.file_fingerprint(dr.data_path(data_file))
+    points = [{'algorithm': algorithm, 'params': params, 'seed': seed}
+              for params in expand_grid(grid) for seed in seeds]
+    keys = [point_key(fingerprint, algorithm, point['params'], point['seed']) for point in points]
+    results = {key: load_result(cache_dir, key) for key in keys}
+    todo = [(key, point) for key, point in zip(keys, points) if results[key] is None]
+    print('Sweep: %d points, %d cached' % (len(points), len(points) - len(todo)))
+
+    if todo:
+        # writes the truth file once before any worker reads it
+        init_sweep_worker(data_file)
+        if workers == 1 or len(todo) == 1:
+            finished = ((key, point, run_point(point)) for key, point in todo)
+            for key, point, measures in finished:
+                save_result(cache_dir, key, point, measures)
+                results[key] = measures
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_sweep_worker,
+                                                        initargs=(data_file,)) as pool:
+                futures = {pool.submit(run_point, point): (key, point) for key, point in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    key, point = futures[future]
+                    save_result(cache_dir, key, point, future.result())
+                    results[key] = future.result()
+
+    return [dict({'dataset': data_file, 'algorithm': algorithm, 'seed': point['seed']},
+                 **point['params'], **results[key])
+            for key, point in zip(keys, points)]
+
+
+def write_csv(rows, filename):
+    """Writes result rows to a CSV file with one column per field."""
+    fields = ['dataset', 'algorithm', 'seed'] + [p for p in PARAMS if any(p in row for row in rows)] + MEASURES
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_grid(specs):
+    """Parses name=v1,v2,... specs into a grid of ints or floats."""
+    grid = {}
+    for spec in specs:
+        name, values = spec.split('=')
+        if name not in PARAMS:
+            raise ValueError('Unknown parameter ' + name)
+        grid[name] = [float(v) if '.' in v or 'e' in v else int(v) for v in values.split(',')]
+    return grid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs an algorithm over a parameter grid.')
+    parser.add_argument('set', help='Data file, e.g. lastfm.dat')
+    parser.add_argument('-a', '--algorithm', required=True,
+                        help='minhash, sec_minhash, bucket, noisy or privmin')
+    parser.add_argument('-g', '--grid', nargs='+', required=True,
+                        help='Parameter values, e.g. num_hashes=50,100 eps=0.5,1.0')
+    parser.add_argument('-r', '--seeds', type=int, nargs='+', default=[0], help='Seeds of the runs')
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes')
+    parser.add_argument('-o', '--output', default='sweep_results.csv', help='CSV file of the results')
+    parser.add_argument('-c', '--cache', default=CACHE_DIR, help='Directory of cached results')
+    args = parser.parse_args()
+
+    rows = run_sweep(args.set, args.algorithm, parse_grid(args.grid), args.seeds, args.workers, args.cache)
+    write_csv(rows, args.output)
+    print('Wrote', args.output)